@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+# coding: UTF-8
+
+# benchmark TRS tokenizers on a synthetic corpus
+
+import os
+import time
+import random
+import argparse
+import tempfile
+from parse_patents import trans, read_lines, patent_generator, record_generator
+
+# random chinese-ish text
+chars = '专利发明实用新型装置方法系统中国北京上海有限公司的一种及其制备'
+def random_text(size):
+    return ''.join(random.choices(chars, k=size))
+
+# write synthetic trs file with long multi-line fields
+def make_corpus(path, size_mb, seed=0):
+    random.seed(seed)
+    tags = list(trans.values())
+    with open(path, 'wb') as fid:
+        while fid.tell() < size_mb*2**20:
+            lines = ['<REC>']
+            for tag in tags:
+                lines.append(f'<{tag}>={random_text(random.randint(4, 32))}')
+                if tag in ('摘要', '主权项'):
+                    lines += [random_text(60) for _ in range(random.randint(5, 40))]
+            fid.write(('\r\n'.join(lines) + '\r\n').encode('gb18030'))
+
+# time a generator over the whole corpus
+def run(name, gen, size):
+    time0 = time.time()
+    recs = list(gen)
+    delta = time.time() - time0
+    print(f'{name:>5}: {len(recs)} records, {delta:.2f}s, {size/2**20/delta:.1f} MB/s')
+    return recs
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='TRS tokenizer benchmark.')
+    parser.add_argument('--size', type=int, default=64, help='corpus size (MB)')
+    parser.add_argument('--path', type=str, default=None, help='existing TRS file to use instead')
+    args = parser.parse_args()
+
+    if args.path is None:
+        fid, path = tempfile.mkstemp(suffix='.trs')
+        os.close(fid)
+        make_corpus(path, args.size)
+    else:
+        path = args.path
+
+    try:
+        size = os.path.getsize(path)
+        line = run('line', patent_generator(read_lines(path)), size)
+        fast = run('fast', record_generator(path), size)
+        same = [tuple(p.get(k) for k in trans) for p in line] == fast
+        print(f'identical: {same}')
+    finally:
+        if args.path is None:
+            os.remove(path)
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# coding: UTF-8
+
+# benchmark similarity kernels on synthetic vectors
+
+import time
+import argparse
+import torch
+from similarity import topk_blocked, topk_sorted, mean_blocked, mean_sums, compute_dtype
+from quantize import quantize, matmul_t, to_compute
+
+# random unit vectors with random application days
+def make_vectors(n, dim, n_years=20, seed=0):
+    gen = torch.Generator().manual_seed(seed)
+    vecs = torch.randn((n, dim), generator=gen)
+    vecs /= vecs.norm(dim=1, keepdim=True)
+    days = torch.randint(0, 365*n_years, (n,), generator=gen)
+    return vecs.half(), days
+
+# time a kernel and report comparisons per second
+def run(name, func, pairs):
+    time0 = time.time()
+    out = func()
+    delta = time.time() - time0
+    print(f'{name:>5}: {delta:.2f}s, {pairs/delta:.3g} pairs/s')
+    return out
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Similarity kernel benchmark.')
+    parser.add_argument('--size', type=int, default=100_000, help='comparison vectors')
+    parser.add_argument('--queries', type=int, default=2048, help='query vectors')
+    parser.add_argument('--sorted-size', type=int, default=20_000, help='self join size for full vs date-sorted top-k')
+    parser.add_argument('--dim', type=int, default=384, help='vector dimension')
+    parser.add_argument('--topk', type=int, default=100, help='neighbors to keep')
+    parser.add_argument('--device', type=str, default='cpu', help='torch device')
+    parser.add_argument('--dtype', type=str, default=None, help='compute dtype (float32, bfloat16, float16, int8)')
+    parser.add_argument('--block-size', type=int, default=None, help='comparison block width (default sized to cache)')
+    parser.add_argument('--threads', type=int, default=None, help='torch cpu threads')
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    dtype = compute_dtype(args.device, args.dtype)
+    print(f'device = {args.device}, dtype = {dtype}, threads = {torch.get_num_threads()}')
+
+    # int8 compares against a pre-quantized store
+    vecs, days = make_vectors(args.size, args.dim)
+    base = quantize(vecs) if dtype == torch.int8 else vecs
+    query, days_q = base[:args.queries], days[:args.queries]
+    year_idx = days // 365
+    pairs = args.queries * args.size
+
+    kwargs = dict(block_size=args.block_size, device=args.device, dtype=dtype)
+    idxt, simt = run('topk', lambda: topk_blocked(query, base, days_q, days, topk=args.topk, **kwargs), pairs)
+    # date-sorted self join over numpy tiles (as if memory-mapped), counting all n^2 pairs
+    n = args.sorted_size
+    order = torch.argsort(days[:n], stable=True).numpy()
+    base_s, days_s = vecs[:n].numpy()[order], days[:n].numpy()[order]
+    run('full', lambda: topk_blocked(base[:n], base[:n], days[:n], days[:n], topk=args.topk, **kwargs), n*n)
+    run('sort', lambda: topk_sorted(base_s, base_s, days_s, topk=args.topk, device=args.device, dtype=dtype), n*n)
+    avgt, _ = run('mean', lambda: mean_blocked(query, base, year_idx, int(year_idx.max())+1, **kwargs), pairs)
+    avgs, _ = run('sums', lambda: mean_sums(query, base, year_idx, int(year_idx.max())+1, device=args.device), pairs)
+
+    # check a few rows against one unblocked matmul
+    sims = matmul_t(to_compute(query[:64], args.device, dtype), to_compute(base, args.device, dtype))
+    simb = torch.where(days[None,:].to(args.device) < days_q[:64,None].to(args.device), sims.float(), -torch.inf)
+    top = simb.topk(args.topk, dim=1).values.half()
+    print(f'topk max err: {(top - simt[:64]).float().abs().nan_to_num().max():.2e}')
+    ref = torch.zeros((64, avgt.shape[1]), device=args.device).index_add_(1, year_idx.to(args.device), sims.float())
+    ref /= torch.bincount(year_idx, minlength=avgt.shape[1]).to(args.device)
+    print(f'mean max err: {(ref - avgt[:64].float()).abs().max():.2e}')
+    print(f'sums max err: {(avgs.float() - avgt.float()).abs().max():.2e}')
@@ -1,7 +1,11 @@
+import os
 import argparse
 import sqlite3
+import numpy as np
 import pandas as pd
-from itertools import chain
+from tools import normalize_names, read_table, ColumnWriter, patents_db
+from simhash import Cluster
+from matching import sign_names, verify_pairs
 
 # arguments
 parser = argparse.ArgumentParser(description='Match firm and patent data.')
@@ -9,21 +13,100 @@ parser.add_argument('--input', type=str, help='input firm data')
 parser.add_argument('--output', type=str, help='output filename')
 parser.add_argument('--idcol', type=str, default='id', help='id column name')
 parser.add_argument('--namecol', type=str, default='name', help='name column name')
+parser.add_argument('--db', type=str, default=patents_db, help='patent database path')
+parser.add_argument('--chunk', type=int, default=1_000_000, help='patents per chunk')
+parser.add_argument('--fuzzy', action='store_true', help='fuzzy match names with no exact match')
+parser.add_argument('--thresh', type=float, default=0.1, help='normalized levenshtein threshold for fuzzy matches')
+parser.add_argument('--bands', type=int, default=8, help='simhash bands for fuzzy blocking')
+parser.add_argument('--band-thresh', type=int, default=1, help='bands shared beyond this are candidates')
+parser.add_argument('--workers', type=int, default=1, help='processes for fuzzy verification')
 args = parser.parse_args()
 
 # load tax data
-tax_df = pd.read_csv(args.input, usecols=[args.idcol, args.namecol])
+tax_df = read_table(args.input, columns=[args.idcol, args.namecol])
 tax_df = tax_df.rename(columns={args.idcol: 'id', args.namecol: 'name'})
 tax_df = tax_df.drop_duplicates(subset='id')
 
-# load patent data
-with sqlite3.connect('/home/doug/data/patents_china/store/patents.db') as con:
-    pat_df = pd.read_sql('select appnum,appname,appdate from patent', con)
+# normalized name to firm ids (firms can share a name, each one is a match)
+tax_df['id'] = tax_df['id'].astype(str)
+tax_df['name'] = normalize_names(tax_df['name'].astype(str))
+firm_ids = tax_df[['name', 'id']]
 
-# split names
-pat1_df = pd.DataFrame(list(chain(*[[(s['appnum'], s['appdate'], x) for x in s['appname'].split(';')] for _, s in pat_df.iterrows()])), columns=['appnum', 'appdate', 'appname'])
+# output schema
+schema = {'appnum': 'str', 'appdate': 'str', 'id': 'str', 'match': 'str', 'dist': 'float'}
 
-# merge datasets
-merged = pd.merge(pat1_df[['appnum', 'appdate', 'appname']], tax_df[['id', 'name']], left_on='appname', right_on='name', how='left')[['appnum', 'appdate', 'id']]
+# exact pass goes to intermediate file if fuzzy pass follows
+exact_path = f'{args.output}.exact' if args.fuzzy else args.output
+unmatched = set()
 
-merged.to_csv(args.output, index=False)
+# stream patent data, writing on a background thread
+exact_schema = {**schema, 'appname': 'str'} if args.fuzzy else schema
+with sqlite3.connect(args.db) as con, ColumnWriter(exact_path, exact_schema, chunk_size=args.chunk) as writer:
+    chunks = pd.read_sql('select appnum,appname,appdate from patent', con, chunksize=args.chunk)
+    for i, pat_df in enumerate(chunks):
+        # split names
+        pat1_df = pat_df.assign(appname=pat_df['appname'].str.split(';')).explode('appname')
+        pat1_df['appname'] = normalize_names(pat1_df['appname'])
+
+        # match names, one row per matching firm
+        pat1_df = pat1_df.merge(firm_ids, left_on='appname', right_on='name', how='left').drop(columns='name')
+        matched = pat1_df['id'].notna()
+        pat1_df['match'] = np.where(matched, 'exact', None)
+        pat1_df['dist'] = np.where(matched, 0.0, np.nan)
+
+        # remember distinct unmatched names
+        if args.fuzzy:
+            unmatched.update(pat1_df.loc[~matched, 'appname'].dropna().unique())
+
+        # append to output
+        writer.insertframe(pat1_df)
+        print(f'{i}: {len(pat_df)} patents, {matched.sum()} matched')
+
+# fuzzy pass over distinct unmatched names only
+if args.fuzzy:
+    names = sorted(unmatched)
+    firm_names = firm_ids['name'].unique().tolist()
+    print(f'fuzzy matching {len(names)} names against {len(firm_names)} firms')
+
+    # block with simhash bands over firm names
+    index = Cluster(k=args.bands, thresh=args.band_thresh)
+    index.build(sign_names(firm_names))
+
+    # candidate pairs, querying in chunks
+    def candidates():
+        total = 0
+        for i1 in range(0, len(names), args.chunk):
+            batch = names[i1:i1+args.chunk]
+            cands = index.query(sign_names(batch))
+            count = sum(map(len, cands))
+            total += count
+            print(f'{i1}: {len(batch)} names, {count} candidates ({count/len(batch):.1f} per name)')
+            for name, js in zip(batch, cands):
+                for j in js:
+                    yield name, firm_names[j]
+        print(f'{total} candidate pairs ({total/max(1, len(names)*len(firm_names)):.4%} of names x firms)')
+
+    # verify and keep closest firm
+    best = {}
+    for name, firm, dist in verify_pairs(candidates(), thresh=args.thresh, workers=args.workers):
+        if name not in best or dist < best[name][1]:
+            best[name] = (firm, dist)
+    fuzzy = pd.DataFrame(
+        [(name, firm, dist) for name, (firm, dist) in best.items()],
+        columns=['appname', 'fuzzy_name', 'fuzzy_dist']
+    ).astype({'fuzzy_dist': float})
+    fuzzy = fuzzy.merge(firm_ids, left_on='fuzzy_name', right_on='name')
+    fuzzy = fuzzy.rename(columns={'id': 'fuzzy_id'})[['appname', 'fuzzy_id', 'fuzzy_dist']].set_index('appname')
+    print(f'fuzzy matched {len(fuzzy)} names')
+
+    # fill in fuzzy matches
+    dtype = {'appnum': str, 'appdate': str, 'id': str, 'appname': str, 'match': str}
+    with ColumnWriter(args.output, schema, chunk_size=args.chunk) as writer:
+        for pat1_df in pd.read_csv(exact_path, dtype=dtype, chunksize=args.chunk):
+            pat1_df = pat1_df.join(fuzzy, on='appname').reset_index(drop=True)
+            hit = pat1_df['id'].isna() & pat1_df['fuzzy_id'].notna()
+            pat1_df.loc[hit, 'id'] = pat1_df.loc[hit, 'fuzzy_id']
+            pat1_df.loc[hit, 'match'] = 'fuzzy'
+            pat1_df.loc[hit, 'dist'] = pat1_df.loc[hit, 'fuzzy_dist']
+            writer.insertframe(pat1_df)
+    os.remove(exact_path)
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# coding: UTF-8
+
+# bulk load parsed patents into sqlite
+
+import os
+import sys
+import time
+import argparse
+import sqlite3
+import pandas as pd
+from glob import glob
+from tools import normalize_names, read_chunks, patents_db
+from parse_patents import trans, parse_dates
+
+# column types (everything else is text)
+types = {'pages': 'integer'}
+date_cols = ['pubdate', 'appdate']
+
+# indexes built after loading
+indexes = {
+    'idx_patent_appnum': 'patent(appnum)',
+    'idx_patent_patnum': 'patent(patnum)',
+    'idx_patent_appdate': 'patent(appdate)',
+    'idx_applicant_name': 'applicant(name)',
+    'idx_applicant_appnum': 'applicant(appnum)',
+}
+
+# conform chunk to table schema, dates as ISO strings so ranges sort
+def conform(frame):
+    frame = frame.reindex(columns=list(trans))
+    for col in date_cols:
+        # raw TRS strings from csv, dates already typed from parquet
+        dates = frame[col]
+        if pd.api.types.infer_dtype(dates, skipna=True) == 'string':
+            dates = parse_dates(dates, col)
+        frame[col] = pd.to_datetime(dates, errors='coerce').dt.strftime('%Y-%m-%d')
+    frame['pages'] = pd.to_numeric(frame['pages'], errors='coerce').astype('Int64')
+    return frame.astype(object).where(frame.notna(), None)
+
+# one row per (appnum, normalized applicant name)
+def applicants(frame):
+    names = frame[['appnum', 'appname']].dropna()
+    names = names.assign(appname=names['appname'].str.split(';')).explode('appname')
+    names['appname'] = normalize_names(names['appname'])
+    return names[names['appname'].str.len() > 0]
+
+def create_tables(con):
+    cols = ', '.join(f'{k} {types.get(k, "text")}' for k in trans)
+    con.execute(f'create table if not exists patent ({cols})')
+    con.execute('create table if not exists applicant (appnum text, name text)')
+
+def create_indexes(con):
+    for name, target in indexes.items():
+        print(f'Indexing: {name}')
+        con.execute(f'create index if not exists {name} on {target}')
+    con.execute('analyze')
+
+def load_patents(paths, db, chunk=100_000, clobber=False):
+    if clobber and os.path.exists(db):
+        os.remove(db)
+
+    os.makedirs(os.path.dirname(db) or '.', exist_ok=True)
+    con = sqlite3.connect(db)
+
+    # loading twice would duplicate every row
+    tables = {name for name, in con.execute("select name from sqlite_master where type = 'table'")}
+    if 'patent' in tables and con.execute('select count(*) from patent').fetchone()[0] > 0:
+        con.close()
+        raise Exception(f'{db} already has patents, use clobber to reload')
+
+    # relaxed durability while bulk loading
+    con.execute('pragma journal_mode=WAL')
+    con.execute('pragma synchronous=OFF')
+    con.execute('pragma cache_size=-1000000')
+    con.execute('pragma temp_store=MEMORY')
+    create_tables(con)
+
+    # insert one transaction per chunk
+    insert_pat = f'insert into patent values ({",".join("?"*len(trans))})'
+    insert_app = 'insert into applicant values (?, ?)'
+    tot = 0
+    time0 = time.time()
+    for path in paths:
+        print(f'Loading: {path}')
+        for frame in read_chunks(path, chunk, dtype=str):
+            frame = conform(frame)
+            with con:
+                con.executemany(insert_pat, frame.itertuples(index=False, name=None))
+                con.executemany(insert_app, applicants(frame).itertuples(index=False, name=None))
+            tot += len(frame)
+            print(f'tot = {tot} ({tot/(time.time()-time0):.0f} rows/s)')
+
+    # index once everything is in
+    create_indexes(con)
+    con.execute('pragma synchronous=NORMAL')
+    con.close()
+
+    return tot
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Bulk load parsed patents into sqlite.')
+    parser.add_argument('inputs', type=str, nargs='+', help='parsed csv/parquet files, globs, or parquet directories')
+    parser.add_argument('--db', type=str, default=patents_db, help='database path')
+    parser.add_argument('--chunk', type=int, default=100_000, help='rows per transaction')
+    parser.add_argument('--clobber', action='store_true', help='delete database and restart')
+    args = parser.parse_args()
+
+    # expand globs, keep directories as parquet datasets
+    paths = [p for arg in args.inputs for p in ([arg] if os.path.isdir(arg) else sorted(glob(arg)))]
+    if len(paths) == 0:
+        print('No inputs found')
+        sys.exit(1)
+
+    load_patents(paths, args.db, chunk=args.chunk, clobber=args.clobber)
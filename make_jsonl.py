@@ -1,6 +1,10 @@
+import os
 import json
 import pandas as pd
 from glob import glob
+from collections import deque
+from multiprocessing import Pool
+from tools import openers
 
 # globals
 columns_utility = ['app_no', 'app_date', 'title', 'claims', 'abstract']
@@ -10,8 +14,16 @@ columns_output = ['appnum', 'appdate', 'title', 'claims', 'abstract']
 rename_utility = {'app_no': 'appnum', 'app_date': 'appdate'}
 rename_invention = {}
 
-# combine utility CSV files
-def merge_patents(indir, outpath, mode):
+# read and conform one CSV file
+def merge_worker(task):
+    path, columns, rename = task
+    data = pd.read_csv(path, usecols=columns, encoding_errors='ignore')
+    data = data.rename(rename, axis=1)[columns_output]
+    data['appdate'] = pd.to_datetime(data['appdate'])
+    return path, data.to_csv(header=False, index=False)
+
+# combine utility CSV files (in order, reading up to workers files at once)
+def merge_patents(indir, outpath, mode, workers=1):
     if mode == 'utility':
         columns = columns_utility
         rename = rename_utility
@@ -19,14 +31,27 @@ def merge_patents(indir, outpath, mode):
         columns = columns_invention
         rename = rename_invention
 
+    tasks = [(path, columns, rename) for path in sorted(glob(f'{indir}/*.csv'))]
     with open(outpath, 'w') as fid:
         fid.write(','.join(columns_output)+'\n')
-        for path in sorted(glob(f'{indir}/*.csv')):
+        for path, text in ordered_map(merge_worker, tasks, workers):
             print(path)
-            data = pd.read_csv(path, usecols=columns, encoding_errors='ignore')
-            data = data.rename(rename, axis=1)[columns_output]
-            data['appdate'] = pd.to_datetime(data['appdate'])
-            data.to_csv(fid, header=False, index=False)
+            fid.write(text)
+
+# map over pool keeping order, with bounded number of tasks in flight
+def ordered_map(func, tasks, workers=1):
+    if workers <= 1:
+        yield from map(func, tasks)
+        return
+
+    with Pool(workers) as pool:
+        pending = deque()
+        for task in tasks:
+            pending.append(pool.apply_async(func, (task,)))
+            if len(pending) >= 2*workers:
+                yield pending.popleft().get()
+        while len(pending) > 0:
+            yield pending.popleft().get()
 
 # write to json
 def make_jsonl(inpath, outpath, chunk=8192, limit=None):
@@ -40,6 +65,48 @@ def make_jsonl(inpath, outpath, chunk=8192, limit=None):
                 json.dump(dat, fid, ensure_ascii=False)
                 fid.write('\n')
 
+# serialize chunk to jsonl lines, missing fields format as in make_jsonl
+def jsonl_worker(batch):
+    text = batch['title'].fillna('nan') + '\n' + batch['claims'].fillna('nan') + '\n' + batch['abstract'].fillna('nan')
+    return ''.join(
+        json.dumps({'appnum': a, 'text': t}, ensure_ascii=False) + '\n'
+        for a, t in zip(batch['appnum'], text)
+    )
+
+# path of i-th shard, patents.jsonl.gz -> patents-00001.jsonl.gz
+def shard_path(outpath, i):
+    dirname, filename = os.path.split(outpath)
+    root, _, ext = filename.partition('.')
+    return os.path.join(dirname, f'{root}-{i:05d}.{ext}')
+
+# open plain or compressed (by extension) output
+def open_output(path):
+    _, ext = os.path.splitext(path)
+    return openers.get(ext, open)(path, 'wt')
+
+# write to json over a process pool, optionally in ordered shards of at least shard_size lines
+def make_jsonl_parallel(inpath, outpath, chunk=8192, limit=None, workers=4, shard_size=None):
+    dtype = {k: str for k in ['appnum', 'title', 'claims', 'abstract']}
+    batches = pd.read_csv(inpath, usecols=list(dtype), dtype=dtype, chunksize=chunk, nrows=limit)
+
+    shard = 0
+    lines = 0
+    fid = open_output(shard_path(outpath, shard) if shard_size is not None else outpath)
+    try:
+        for text in ordered_map(jsonl_worker, batches, workers):
+            # roll over to next shard at chunk boundaries
+            if shard_size is not None and lines >= shard_size:
+                fid.close()
+                shard += 1
+                lines = 0
+                fid = open_output(shard_path(outpath, shard))
+            fid.write(text)
+            lines += text.count('\n')
+    finally:
+        fid.close()
+
+    return shard + 1
+
 # load with ziggy (4 hours on A6000)
 # emb = ziggy.LlamaCppEmbedding('bge-small-zh-v1.5-f16.gguf')
 # db = ziggy.DocumentDatabase.from_jsonl('patents.jsonl', embed=emb, name_col='patnum', qspec=ziggy.quant.Half)
@@ -1,5 +1,10 @@
 from time import time
-from simhash import Cluster
+from collections import deque
+from functools import partial
+from itertools import islice, combinations
+from multiprocessing import Pool
+import numpy as np
+from simhash import Cluster, CSimhash
 from distance.cdistance import levenshtein
 
 default_dist = lambda s1, s2: levenshtein(s1, s2, normalized=True)
@@ -10,8 +15,15 @@ def shingle(s, k=2):
     for i in range(len(s) - k + 1):
         yield s[i:i+k]
 
+# picklable shingle list for worker processes
+def shingle_list(s, k=2):
+    return list(shingle(s, k=k))
+
 # k = 8, thresh = 4 works well
-def close_pairs(name_dict, preproc=None, nshingle=2, output=1000, **kwargs):
+def close_pairs(name_dict, preproc=None, nshingle=2, output=1000, workers=1, **kwargs):
+    if workers > 1:
+        return close_pairs_parallel(name_dict, preproc=preproc, nshingle=nshingle, workers=workers, **kwargs)
+
     c = Cluster(**kwargs)
 
     if preproc is None:
@@ -29,5 +41,170 @@ def close_pairs(name_dict, preproc=None, nshingle=2, output=1000, **kwargs):
     npairs = [(name_dict[i1], name_dict[i2]) for i1, i2 in ipairs]
     return (ipairs, npairs)
 
+# sign a chunk of names in a worker
+def sign_worker(task):
+    names, preproc = task
+    return CSimhash().simhash_batch([preproc(s) for s in names])
+
+# all (later, earlier) position pairs with equal keys in one band
+def band_pairs(keys):
+    n = len(keys)
+    order = np.argsort(keys, kind='stable')
+    skeys = keys[order]
+
+    # end of the run each sorted position belongs to
+    starts = np.flatnonzero(np.r_[True, skeys[1:] != skeys[:-1]])
+    ends = np.r_[starts[1:], n]
+    run_end = np.repeat(ends, ends - starts)
+
+    # pair each position with those d steps ahead in the same run
+    src, dst = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+    live = np.arange(n)
+    d = 1
+    live = live[live + d < run_end]
+    while len(live) > 0:
+        src.append(order[live + d])
+        dst.append(order[live])
+        d += 1
+        live = live[live + d < run_end[live]]
+
+    return np.concatenate(src), np.concatenate(dst)
+
+# share signatures and band layout with band workers, once per process
+def band_init(sigs, offsets, masks, thresh):
+    global band_state
+    band_state = (sigs, offsets, masks, thresh)
+
+# pairs sharing more than thresh bands whose first thresh+1 shared bands are exactly combo
+def combo_pairs(combo):
+    sigs, offsets, masks, thresh = band_state
+
+    # agreeing on every band in combo is agreeing on all of their bits at once
+    mask = np.uint64(0)
+    for b in combo:
+        mask |= masks[b] << offsets[b]
+    src, dst = band_pairs(sigs & mask)
+
+    # drop pairs also sharing an earlier band outside combo, those belong to another combo
+    diff = sigs[src] ^ sigs[dst]
+    keep = np.ones(len(src), dtype=bool)
+    for b in range(combo[-1]):
+        if b not in combo:
+            keep &= (diff >> offsets[b]) & masks[b] != 0
+
+    return src[keep], dst[keep]
+
+# same output as close_pairs, with signing over a pool and band combinations split over workers
+def close_pairs_parallel(name_dict, preproc=None, nshingle=2, workers=8, chunk=100_000, **kwargs):
+    c = Cluster(**kwargs)
+
+    if preproc is None:
+        preproc = partial(shingle_list, k=nshingle)
+
+    labels = list(name_dict.keys())
+    names = list(name_dict.values())
+    n = len(names)
+
+    t0 = time()
+    with Pool(workers) as pool:
+        # sign names in chunks
+        tasks = [(names[i:i+chunk], preproc) for i in range(0, n, chunk)]
+        sigs = np.concatenate([np.zeros(0, dtype=np.uint64)] + pool.map(sign_worker, tasks))
+        print(f'signed {n},{time()-t0}')
+
+    # each qualifying pair is found by exactly one (thresh+1)-band combination
+    combos = list(combinations(range(c.k), c.thresh+1))
+    src, dst, band = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+    with Pool(workers, initializer=band_init, initargs=(sigs, c.offsets, c.bin_masks, c.thresh)) as pool:
+        for combo, (s, d) in zip(combos, pool.imap(combo_pairs, combos)):
+            src.append(s)
+            dst.append(d)
+            band.append(np.full(len(s), combo[0]))
+    print(f'banded {n},{time()-t0}')
+    src, dst, band = np.concatenate(src), np.concatenate(dst), np.concatenate(band)
+
+    # order as the incremental path emits them (first shared band is the combo's lowest)
+    order = np.lexsort((dst, band, src))
+
+    # return results
+    ipairs = [(labels[i1], labels[i2]) for i1, i2 in zip(src[order], dst[order])]
+    npairs = [(name_dict[i1], name_dict[i2]) for i1, i2 in ipairs]
+    return (ipairs, npairs)
+
+# sign names in one batch, with 64-bit feature hashes so every band carries information
+def sign_names(names, preproc=None, nshingle=2):
+    if preproc is None:
+        preproc = partial(shingle_list, k=nshingle)
+    return CSimhash().simhash_batch([preproc(s) for s in names], wide=True)
+
+# build and save persistent index for name_dict
+def build_index(name_dict, path, preproc=None, nshingle=2, **kwargs):
+    c = Cluster(**kwargs)
+    c.build(sign_names(list(name_dict.values()), preproc, nshingle), list(name_dict.keys()))
+    c.save(path)
+    return c
+
+# near-duplicate stored labels for each new name
+def query_index(path, names, preproc=None, nshingle=2):
+    c = Cluster.load(path)
+    return c.query(sign_names(names, preproc, nshingle))
+
+# add new names to saved index
+def append_index(path, name_dict, preproc=None, nshingle=2):
+    c = Cluster.load(path)
+    c.append(sign_names(list(name_dict.values()), preproc, nshingle), list(name_dict.keys()))
+    c.save(path)
+    return c
+
+# normalized levenshtein if at most thresh else None, skipping hopeless pairs early
+def bounded_dist(s1, s2, thresh):
+    if s1 == s2:
+        return 0.0
+    n = max(len(s1), len(s2))
+    if min(len(s1), len(s2)) == 0:
+        return 1.0 if thresh >= 1.0 else None
+
+    # distance is at least the length difference
+    if abs(len(s1) - len(s2)) > thresh*n:
+        return None
+
+    # stop once distance exceeds bound
+    d = levenshtein(s1, s2, max_dist=int(thresh*n)+1)
+    if d < 0 or d / n > thresh:
+        return None
+    return d / n
+
 def filter_pairs(pairs, thresh=0.1, dist=default_dist):
+    if dist is default_dist:
+        return [(s1, s2) for s1, s2 in pairs if bounded_dist(s1, s2, thresh) is not None]
     return [(s1, s2) for s1, s2 in pairs if dist(s1, s2) <= thresh]
+
+# verify a chunk of pairs in a worker, dropping repeats within the chunk
+def verify_worker(task):
+    pairs, thresh = task
+    output = []
+    for s1, s2 in dict.fromkeys(pairs):
+        d = bounded_dist(s1, s2, thresh)
+        if d is not None:
+            output.append((s1, s2, d))
+    return output
+
+# stream (s1, s2, dist) for pairs within thresh, verifying chunks over a pool in order
+def verify_pairs(pairs, thresh=0.1, workers=1, chunk=100_000):
+    pairs = iter(pairs)
+    chunks = iter(lambda: list(islice(pairs, chunk)), [])
+
+    if workers <= 1:
+        for batch in chunks:
+            yield from verify_worker((batch, thresh))
+        return
+
+    # keep a bounded number of chunks in flight so input is never fully materialized
+    with Pool(workers) as pool:
+        pending = deque()
+        for batch in chunks:
+            pending.append(pool.apply_async(verify_worker, ((batch, thresh),)))
+            if len(pending) >= 2*workers:
+                yield from pending.popleft().get()
+        while len(pending) > 0:
+            yield from pending.popleft().get()
@@ -3,36 +3,15 @@
 
 import re
 import os
+import json
 import sys
+import time
+import shutil
 import argparse
 import pandas as pd
-from collections import defaultdict
+from glob import glob
 from itertools import islice
-
-# parse input arguments
-parser = argparse.ArgumentParser(description='China patent parser.')
-parser.add_argument('inpath', type=str, help='TRS file to parse')
-parser.add_argument('--outdir', type=str, default=None, help='directory to store to')
-parser.add_argument('--clobber', action='store_true', help='delete database and restart')
-parser.add_argument('--output', action='store_true', help='print out patents per')
-parser.add_argument('--chunk', type=int, default=100_000, help='chunk size')
-parser.add_argument('--limit', type=int, default=None, help='only parse n patents')
-args = parser.parse_args()
-
-# announce
-if not args.clobber and os.path.exists(args.outpath):
-    print(f'Skipping: {args.inpath}')
-    sys.exit(0)
-else:
-    print(f'Parsing: {args.inpath}')
-
-# construct output path
-if args.outdir is not None:
-    filename = os.path.basename(args.inpath)
-    basename, _ = os.path.splitext(filename)
-    outpath = os.path.join(args.outdir, f'{basename}.csv')
-else:
-    outpath = None
+from multiprocessing import Pool
 
 # database schema
 trans = {
@@ -59,11 +38,59 @@ trans = {
     'sipoclass': '范畴分类', # Classification by SIPO
 }
 rtrans = {v: k for k, v in trans.items()}
+tindex = {v: i for i, v in enumerate(trans.values())}
+
+# typed columns for columnar output
+date_cols = ['pubdate', 'appdate']
+cat_cols = ['province', 'type']
+int_cols = ['pages']
+date_format = '%Y.%m.%d'
+
+# precompiled tag pattern
+tag_re = re.compile('<([^\x00-\x7F][^>]*)>=(.*)')
+
+# record boundary marker, newline and ascii never occur inside gb18030 multibyte chars
+rec_mark = b'\n<REC>'
+
+# find first record boundary at or after byte offset pos
+def find_record(fid, pos, block=1<<20):
+    if pos <= 0:
+        return 0
+    start = pos - 1
+    while True:
+        fid.seek(start)
+        data = fid.read(block)
+        idx = data.find(rec_mark)
+        if idx >= 0:
+            return start + idx + 1
+        if len(data) < block:
+            return start + len(data)
+        start += block - len(rec_mark) + 1
+
+# split file into byte ranges aligned to record boundaries
+def shard_ranges(inpath, shards):
+    size = os.path.getsize(inpath)
+    with open(inpath, 'rb') as fid:
+        bounds = [find_record(fid, size*i//shards) for i in range(shards)] + [size]
+    return [(b1, b2) for b1, b2 in zip(bounds[:-1], bounds[1:]) if b2 > b1]
+
+# decode lines in byte range [start, end), where start is a record boundary
+def read_lines(inpath, start=0, end=None):
+    with open(inpath, 'rb') as fid:
+        fid.seek(start)
+        pos = start
+        for line in fid:
+            if end is not None and pos >= end:
+                break
+            pos += len(line)
+            yield line.decode('gb18030', errors='ignore')
 
 # parse file
-def patent_generator(fid):
+def patent_generator(lines):
     pat = None
-    for line in fid:
+    tag = None
+    buf = None
+    for line in lines:
         # skip empty lines
         line = line.strip()
         if len(line) == 0:
@@ -73,10 +100,12 @@ def patent_generator(fid):
         if line == '<REC>':
             # store current
             if pat is not None:
+                if tag in rtrans:
+                    pat[rtrans[tag]] = buf
                 yield pat
 
             # set defaults
-            pat = defaultdict(None)
+            pat = {}
 
             # clear buffer
             tag = None
@@ -85,7 +114,7 @@ def patent_generator(fid):
             continue
 
         # start tag
-        ret = re.match('<([^\x00-\x7F][^>]*)>=(.*)', line)
+        ret = tag_re.match(line)
         if ret:
             # store old
             if tag in rtrans:
@@ -98,35 +127,444 @@ def patent_generator(fid):
             # continue existing
             buf += line
 
-# open and parse
-with open(args.inpath, encoding='gb18030', errors='ignore') as fid:
+    # store final
+    if pat is not None:
+        if tag in rtrans:
+            pat[rtrans[tag]] = buf
+        yield pat
+
+# read raw record bodies in bulk blocks, with the byte offset where each one ends
+# (range must start on a record boundary)
+def read_records(inpath, start=0, end=None, block=1<<24):
+    with open(inpath, 'rb') as fid:
+        fid.seek(start)
+        left = end - start if end is not None else -1
+        first = True
+        pos = start
+        tail = b''
+        while left != 0:
+            # read next block
+            data = fid.read(block if left < 0 else min(block, left))
+            if len(data) == 0:
+                break
+            if left > 0:
+                left -= len(data)
+
+            # split off complete records, keep trailing partial one
+            recs = (tail + data).split(rec_mark)
+            tail = recs.pop()
+
+            for rec in recs:
+                # next record starts after the newline
+                pos1 = pos + len(rec) + 1
+
+                # drop leading marker (or preamble) of first record
+                if first:
+                    first = False
+                    if rec.startswith(b'<REC>'):
+                        yield pos1, rec[5:]
+                else:
+                    yield pos1, rec
+
+                pos = pos1 + len(rec_mark) - 1
+
+        # final record
+        if first:
+            if tail.startswith(b'<REC>'):
+                yield pos + len(tail), tail[5:]
+        else:
+            yield pos + len(tail), tail
+
+# parse record body into tuple in trans column order
+def parse_record(rec):
+    vals = [None]*len(tindex)
+    idx = None
+    parts = None
+    for line in rec.decode('gb18030', errors='ignore').split('\n'):
+        # skip empty lines
+        line = line.strip()
+        if len(line) == 0:
+            continue
+
+        # start tag or continue existing
+        ret = tag_re.match(line) if line[0] == '<' else None
+        if ret:
+            if idx is not None:
+                vals[idx] = ''.join(parts)
+            tag, val = ret.groups()
+            idx = tindex.get(tag)
+            parts = [val]
+        elif parts is not None:
+            parts.append(line)
+
+    # store final
+    if idx is not None:
+        vals[idx] = ''.join(parts)
+
+    return tuple(vals)
+
+# fast tokenizer, same records as patent_generator but as tuples
+def record_generator(inpath, start=0, end=None):
+    for _, rec in read_records(inpath, start, end):
+        yield parse_record(rec)
+
+# arrow schema for columnar output
+def patent_schema():
+    import pyarrow as pa
+    fields = []
+    for k in trans:
+        if k in date_cols:
+            dtype = pa.date32()
+        elif k in cat_cols:
+            dtype = pa.dictionary(pa.int32(), pa.string())
+        elif k in int_cols:
+            dtype = pa.int32()
+        else:
+            dtype = pa.string()
+        fields.append(pa.field(k, dtype))
+    return pa.schema(fields)
+
+# parse dates in the TRS format, reporting values that do not fit rather than dropping them silently
+def parse_dates(col, name):
+    dates = pd.to_datetime(col, format=date_format, errors='coerce')
+    bad = dates.isna() & col.notna() & (col.str.len() > 0)
+    if bad.any():
+        print(f'Warning: {bad.sum()} {name} values not in {date_format} format (e.g. {col[bad].iloc[0]!r})')
+    return dates
+
+# convert string frame to typed arrow table
+def patent_table(frame, schema):
+    import pyarrow as pa
+    arrays = []
+    for field in schema:
+        col = frame[field.name]
+        if field.name in date_cols:
+            arr = pa.array(parse_dates(col, field.name)).cast(pa.date32())
+        elif field.name in cat_cols:
+            arr = pa.array(col, type=pa.string(), from_pandas=True).dictionary_encode()
+        elif field.name in int_cols:
+            arr = pa.array(pd.to_numeric(col, errors='coerce').astype('Int32'), type=pa.int32())
+        else:
+            arr = pa.array(col, type=pa.string(), from_pandas=True)
+        arrays.append(arr)
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+# headerless csv or parquet output, one row group per chunk
+class PartWriter:
+    def __init__(self, path, fmt='csv', append=False):
+        self.fmt = fmt
+        if fmt == 'csv':
+            self.file = open(path, 'a' if append else 'w')
+        elif fmt == 'parquet':
+            import pyarrow.parquet as pq
+            self.schema = patent_schema()
+            self.file = pq.ParquetWriter(path, self.schema)
+        else:
+            raise Exception(f'Unsupported format: {fmt}')
+
+    def write(self, frame):
+        if self.fmt == 'csv':
+            frame.to_csv(self.file, index=False, header=False)
+        else:
+            table = patent_table(frame, self.schema)
+            self.file.write_table(table, row_group_size=len(frame))
+
+    # flush to disk and return committed size (csv only)
+    def sync(self):
+        if self.fmt != 'csv':
+            return None
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        return os.fstat(self.file.fileno()).st_size
+
+    def close(self):
+        self.file.close()
+
+# construct output path
+def output_path(inpath, outdir, fmt='csv'):
+    if outdir is None:
+        return None
+    filename = os.path.basename(inpath)
+    basename, _ = os.path.splitext(filename)
+    return os.path.join(outdir, f'{basename}.{fmt}')
+
+# expand file, directory, or glob into sorted list of inputs
+def find_inputs(inpath):
+    if os.path.isdir(inpath):
+        return sorted(glob(os.path.join(inpath, '*.trs')))
+    else:
+        return sorted(glob(inpath))
+
+# checkpoint sidecar path
+def ckpt_path(outpath):
+    return f'{outpath}.ckpt'
+
+# atomically record progress of a part
+def save_checkpoint(outpath, **state):
+    path = ckpt_path(outpath)
+    with open(f'{path}.tmp', 'w') as fid:
+        json.dump(state, fid)
+    os.replace(f'{path}.tmp', path)
+
+# load checkpoint if it matches this byte range
+def load_checkpoint(outpath, start, end):
+    path = ckpt_path(outpath)
+    if not os.path.exists(path) or not os.path.exists(outpath):
+        return None
+    with open(path) as fid:
+        state = json.load(fid)
+    if state['start'] != start or state['end'] != end:
+        return None
+    return state
+
+# records per second (guard against instant files)
+def rate(num, delta):
+    return num / max(delta, 1e-9)
+
+# parse byte range of file to headerless csv or parquet, checkpointing csv after each chunk
+def parse_range(
+    inpath, outpath=None, start=0, end=None, chunk=100_000, limit=None, output=False,
+    tokenizer='fast', fmt='csv', resume=False
+):
+    # byte offsets are only tracked by fast tokenizer, and parquet can't be truncated
+    checkpoint = outpath is not None and tokenizer == 'fast' and fmt == 'csv'
+
     # initial state
     tot = 0
-    gen = patent_generator(fid)
+    pos = start
+    append = False
 
-    while True:
-        # get up to chunk
-        batch = islice(gen, args.chunk)
-        frame = pd.DataFrame(batch, dtype=str, columns=trans)
-
-        # break if empty
-        if len(frame) == 0:
-            break
-
-        # save to csv
-        if outpath is not None:
-            if tot == 0:
-                frame.to_csv(outpath, index=False, header=True)
-            else:
-                frame.to_csv(outpath, index=False, mode='a', header=False)
-
-        # update counter
-        tot += len(frame)
-
-        # output stats
-        if args.output:
-            print(f'tot = {tot}')
-
-        # break if limit
-        if args.limit is not None and tot >= args.limit:
-            break
+    # pick up from last committed chunk
+    state = load_checkpoint(outpath, start, end) if resume and checkpoint else None
+    if state is not None:
+        if state['done']:
+            print(f'Resuming: {inpath} [{start}] already done ({state["records"]} records)')
+            return state['records']
+        print(f'Resuming: {inpath} [{start}] from byte {state["offset"]} ({state["records"]} records)')
+        os.truncate(outpath, state['size'])
+        pos, tot, append = state['offset'], state['records'], True
+
+    # record generator with end offsets
+    if tokenizer == 'fast':
+        gen = ((off, parse_record(rec)) for off, rec in read_records(inpath, pos, end))
+    elif tokenizer == 'line':
+        gen = ((None, tuple(pat.get(k) for k in trans)) for pat in patent_generator(read_lines(inpath, pos, end)))
+    else:
+        raise Exception(f'Unsupported tokenizer: {tokenizer}')
+    fout = PartWriter(outpath, fmt, append=append) if outpath is not None else None
+
+    try:
+        while True:
+            # get up to chunk
+            batch = list(islice(gen, chunk))
+
+            # break if empty
+            if len(batch) == 0:
+                break
+
+            offsets, recs = zip(*batch)
+            frame = pd.DataFrame(list(recs), dtype=str, columns=trans)
+
+            # save to disk
+            if fout is not None:
+                fout.write(frame)
+
+            # update counter
+            tot += len(frame)
+
+            # commit chunk
+            if checkpoint:
+                size = fout.sync()
+                save_checkpoint(outpath, start=start, end=end, offset=offsets[-1], records=tot, size=size, done=False)
+
+            # output stats
+            if output:
+                print(f'{inpath} [{start}]: tot = {tot}')
+
+            # break if limit
+            if limit is not None and tot >= limit:
+                break
+    finally:
+        if fout is not None:
+            fout.close()
+
+    # mark part complete
+    if checkpoint:
+        size = os.path.getsize(outpath)
+        save_checkpoint(outpath, start=start, end=end, offset=end, records=tot, size=size, done=True)
+
+    return tot
+
+# pool entry point, returns timing info
+def parse_worker(task):
+    inpath, index, outpath, start, end, kwargs = task
+    time0 = time.time()
+    tot = parse_range(inpath, outpath, start, end, **kwargs)
+    return inpath, index, tot, time.time() - time0
+
+# shard output path
+def part_path(outpath, index):
+    return f'{outpath}.part{index}' if outpath is not None else None
+
+# concatenate csv files under a single header, skipping their own headers
+def concat_csv(paths, outpath, header=True):
+    with open(outpath, 'w') as fout:
+        fout.write(','.join(trans) + '\n')
+        for path in paths:
+            with open(path) as fid:
+                if header:
+                    fid.readline()
+                shutil.copyfileobj(fid, fout)
+
+# concatenate parquet files row group by row group
+def concat_parquet(paths, outpath):
+    import pyarrow.parquet as pq
+    with pq.ParquetWriter(outpath, patent_schema()) as writer:
+        for path in paths:
+            pfile = pq.ParquetFile(path)
+            for i in range(pfile.num_row_groups):
+                writer.write_table(pfile.read_row_group(i))
+
+# concatenate shard outputs in order, final output appears atomically
+def stitch_parts(outpath, nparts, fmt='csv'):
+    parts = [part_path(outpath, i) for i in range(nparts)]
+    temp = f'{outpath}.tmp'
+    if fmt == 'csv':
+        concat_csv(parts, temp, header=False)
+    else:
+        concat_parquet(parts, temp)
+    os.replace(temp, outpath)
+    for part in parts:
+        os.remove(part)
+        if os.path.exists(ckpt_path(part)):
+            os.remove(ckpt_path(part))
+
+# combine parsed outputs into one file or a partitioned directory
+def combine_outputs(paths, outpath, fmt='csv', partition=None):
+    print(f'Combining: {len(paths)} files → {outpath}')
+    if partition is not None:
+        if fmt != 'parquet':
+            raise Exception('Partitioned output requires parquet format')
+        import pyarrow.dataset as ds
+        data = ds.dataset(paths, schema=patent_schema(), format='parquet')
+        ds.write_dataset(
+            data, outpath, format='parquet', partitioning=[partition],
+            partitioning_flavor='hive', existing_data_behavior='overwrite_or_ignore'
+        )
+    elif fmt == 'csv':
+        concat_csv(paths, outpath)
+    else:
+        concat_parquet(paths, outpath)
+
+# parse many files over a worker pool, splitting big files into shards
+def parse_files(paths, outdir=None, workers=1, clobber=False, shard_size=None, fmt='csv', **kwargs):
+    kwargs['fmt'] = fmt
+
+    # skip existing outputs
+    files = {}
+    for inpath in paths:
+        outpath = output_path(inpath, outdir, fmt)
+        if not clobber and outpath is not None and os.path.exists(outpath):
+            print(f'Skipping: {inpath}')
+        else:
+            files[inpath] = outpath
+
+    # split into record-aligned shards (only for full parses)
+    tasks = []
+    for inpath, outpath in files.items():
+        size = os.path.getsize(inpath)
+        if shard_size is None or kwargs.get('limit') is not None:
+            ranges = [(0, None)]
+        else:
+            ranges = shard_ranges(inpath, max(1, -(-size // shard_size))) or [(0, None)]
+        print(f'Parsing: {inpath} ({len(ranges)} shards)')
+        for index, (start, end) in enumerate(ranges):
+            tasks.append((inpath, index, part_path(outpath, index), start, end, kwargs))
+
+    # start largest shards first so stragglers overlap
+    def task_size(task):
+        inpath, _, _, start, end, _ = task
+        return (end if end is not None else os.path.getsize(inpath)) - start
+    tasks.sort(key=task_size, reverse=True)
+
+    # track shards outstanding per file
+    remain = {inpath: 0 for inpath in files}
+    for task in tasks:
+        remain[task[0]] += 1
+    nparts = dict(remain)
+    stats = {inpath: [0, 0.0] for inpath in files}
+
+    # run in pool or inline
+    time0 = time.time()
+    total = 0
+    if workers > 1 and len(tasks) > 1:
+        pool = Pool(min(workers, len(tasks)))
+        results = pool.imap_unordered(parse_worker, tasks)
+    else:
+        pool = None
+        results = map(parse_worker, tasks)
+
+    try:
+        for inpath, index, tot, delta in results:
+            total += tot
+            stats[inpath][0] += tot
+            stats[inpath][1] += delta
+            remain[inpath] -= 1
+
+            # stitch once all shards are done
+            if remain[inpath] == 0:
+                outpath = files[inpath]
+                if outpath is not None:
+                    stitch_parts(outpath, nparts[inpath], fmt)
+                ftot, fdelta = stats[inpath]
+                print(f'Finished: {inpath} ({ftot} records, {fdelta:.1f}s, {rate(ftot, fdelta):.0f} rec/s)')
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    # aggregate stats
+    delta = time.time() - time0
+    print(f'Total: {len(files)} files, {total} records, {delta:.1f}s, {rate(total, delta):.0f} rec/s')
+
+    return total
+
+if __name__ == '__main__':
+    # parse input arguments
+    parser = argparse.ArgumentParser(description='China patent parser.')
+    parser.add_argument('inpath', type=str, help='TRS file, directory, or glob to parse')
+    parser.add_argument('--outdir', type=str, default=None, help='directory to store to')
+    parser.add_argument('--clobber', action='store_true', help='delete database and restart')
+    parser.add_argument('--output', action='store_true', help='print out patents per')
+    parser.add_argument('--chunk', type=int, default=100_000, help='chunk size')
+    parser.add_argument('--limit', type=int, default=None, help='only parse n patents')
+    parser.add_argument('--workers', type=int, default=1, help='number of files to parse in parallel')
+    parser.add_argument('--tokenizer', type=str, default='fast', choices=['fast', 'line'], help='record tokenizer to use')
+    parser.add_argument('--format', type=str, default='csv', choices=['csv', 'parquet'], help='output format')
+    parser.add_argument('--combine', type=str, default=None, help='combine outputs into this file or directory')
+    parser.add_argument('--partition', type=str, default=None, help='partition combined parquet output by column')
+    parser.add_argument('--resume', action='store_true', help='continue partial parses from their last checkpoint')
+    parser.add_argument('--shard-size', type=int, default=None, help='split files larger than this (MB) into parallel shards')
+    args = parser.parse_args()
+
+    # find inputs
+    paths = find_inputs(args.inpath)
+    if len(paths) == 0:
+        print(f'No inputs found: {args.inpath}')
+        sys.exit(1)
+
+    # parse everything
+    parse_files(
+        paths, outdir=args.outdir, workers=args.workers, clobber=args.clobber,
+        shard_size=args.shard_size*2**20 if args.shard_size is not None else None,
+        fmt=args.format, chunk=args.chunk, limit=args.limit, output=args.output,
+        tokenizer=args.tokenizer, resume=args.resume
+    )
+
+    # combine into single dataset
+    if args.combine is not None:
+        if args.outdir is None:
+            print('Combining requires --outdir')
+            sys.exit(1)
+        outputs = [output_path(p, args.outdir, args.format) for p in paths]
+        combine_outputs(outputs, args.combine, fmt=args.format, partition=args.partition)
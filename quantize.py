@@ -0,0 +1,126 @@
+# int8 symmetric-quantized and plain float vector stores (directories of .npy files)
+
+import os
+import json
+import torch
+import numpy as np
+
+# int8 vectors with x ≈ values * scale, scale per vector [N, 1] or per dimension [1, D]
+class QuantVectors:
+    def __init__(self, values, scale, mode='vector'):
+        self.values = values
+        self.scale = scale
+        self.mode = mode
+
+    def __len__(self):
+        return len(self.values)
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    @property
+    def device(self):
+        return self.values.device
+
+    @property
+    def dtype(self):
+        return torch.int8
+
+    def __getitem__(self, idx):
+        scale = self.scale[idx] if self.mode == 'vector' else self.scale
+        return QuantVectors(self.values[idx], scale, self.mode)
+
+    # move (still quantized) or dequantize to a float dtype
+    def to(self, device=None, dtype=None):
+        values, scale = self.values.to(device=device), self.scale.to(device=device)
+        if dtype is None or dtype == torch.int8:
+            return QuantVectors(values, scale, self.mode)
+        return (values.float() * scale).to(dtype)
+
+# quantize float vectors, with given or max-abs scales
+def quantize(x, mode='vector', scale=None):
+    x = x.float()
+    if scale is None:
+        scale = x.abs().amax(dim=1 if mode == 'vector' else 0, keepdim=True) / 127
+        scale = scale.clamp(min=1e-12)
+    values = (x / scale).round().clamp(-127, 127).to(torch.int8)
+    return QuantVectors(values, scale, mode)
+
+# int8 matmul with int32 accumulation (cuda kernel needs m > 16 and k, n multiples of 8)
+def int_matmul(a, b):
+    if a.is_cuda and (a.shape[0] <= 16 or a.shape[1] % 8 != 0 or b.shape[1] % 8 != 0):
+        return (a.float() @ b.float()).int()
+    return torch._int_mm(a, b)
+
+# a @ b.T for float tensors or per-vector quantized pairs
+def matmul_t(a, b):
+    if isinstance(a, QuantVectors):
+        return int_matmul(a.values, b.values.T).float() * a.scale * b.scale.T
+    return a @ b.T
+
+# cast vectors for compute, quantizing per vector on the fly for int8
+def to_compute(x, device, dtype):
+    if dtype == torch.int8:
+        if isinstance(x, QuantVectors) and x.mode == 'vector':
+            return x.to(device=device)
+        return quantize(x.to(device=device, dtype=torch.float32))
+    return x.to(device=device, dtype=dtype)
+
+# labeled quantized vectors, saved as a directory of .npy files
+class QuantIndex:
+    def __init__(self, labels, vectors):
+        self.labels = labels
+        self.vectors = vectors
+
+    def __len__(self):
+        return len(self.labels)
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        arrays = {
+            'labels': np.asarray(self.labels),
+            'values': self.vectors.values.cpu().numpy(),
+            'scale': self.vectors.scale.cpu().numpy(),
+        }
+
+        # replace files atomically so existing memory maps stay valid
+        for name, arr in arrays.items():
+            temp = os.path.join(path, f'{name}.tmp.npy')
+            np.save(temp, arr)
+            os.replace(temp, os.path.join(path, f'{name}.npy'))
+
+        with open(os.path.join(path, 'meta.json'), 'w') as fid:
+            json.dump({'mode': self.vectors.mode, 'dim': self.vectors.shape[1]}, fid)
+
+    @classmethod
+    def load(cls, path, device='cpu'):
+        with open(os.path.join(path, 'meta.json')) as fid:
+            meta = json.load(fid)
+        array = lambda name: np.load(os.path.join(path, f'{name}.npy'))
+        values = torch.from_numpy(array('values')).to(device)
+        scale = torch.from_numpy(array('scale')).to(device)
+        return cls(array('labels'), QuantVectors(values, scale, meta['mode']))
+
+# labeled float vectors, saved as a directory of .npy files (as written by merging)
+class ArrayIndex:
+    def __init__(self, labels, vectors):
+        self.labels = labels
+        self.vectors = vectors
+
+    def __len__(self):
+        return len(self.labels)
+
+    # copy-on-write map by default so vectors page in lazily but can still be modified (demean)
+    @classmethod
+    def load(cls, path, mmap_mode='c'):
+        array = lambda name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode=mmap_mode)
+        return cls(array('labels'), torch.from_numpy(array('values')))
+
+# load store directory, quantized or not
+def load_store(path):
+    with open(os.path.join(path, 'meta.json')) as fid:
+        meta = json.load(fid)
+    if 'mode' in meta:
+        return QuantIndex.load(path)
+    return ArrayIndex.load(path)
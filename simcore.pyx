@@ -1,3 +1,6 @@
+cimport cython
+import numpy as np
+
 DEF dim = 64
 
 cdef unsigned long masks[dim]
@@ -32,3 +35,68 @@ def simcore(hashish,weights):
             ans |= masks[j]
 
     return ans
+
+# batched version over flattened features, name i has features offsets[i]:offsets[i+1]
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def simcore_batch(const unsigned long long[:] hashes, const float[:] weights, const long long[:] offsets):
+    cdef Py_ssize_t n = offsets.shape[0] - 1
+    cdef Py_ssize_t i, j, k
+    cdef unsigned long long h, ans
+    cdef float w
+    cdef float acc[dim]
+
+    out = np.zeros(n, dtype=np.uint64)
+    cdef unsigned long long[:] outv = out
+
+    with nogil:
+        for i in range(n):
+            for j in range(dim):
+                acc[j] = 0.0
+
+            for k in range(offsets[i], offsets[i+1]):
+                h = hashes[k]
+                w = weights[k]
+                for j in range(dim):
+                    if (h >> j) & 1:
+                        acc[j] += w
+                    else:
+                        acc[j] -= w
+
+            ans = 0
+            for j in range(dim):
+                if acc[j] >= 0:
+                    ans |= (<unsigned long long>1) << j
+            outv[i] = ans
+
+    return out
+
+# union-find over int64 parent array, modified in place
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline Py_ssize_t uf_find(long long[:] parent, Py_ssize_t i) nogil:
+    while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+    return i
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def uf_union(long long[:] parent, const long long[:] src, const long long[:] dst):
+    cdef Py_ssize_t k, a, b
+    with nogil:
+        for k in range(src.shape[0]):
+            a = uf_find(parent, src[k])
+            b = uf_find(parent, dst[k])
+            if a < b:
+                parent[b] = a
+            elif b < a:
+                parent[a] = b
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def uf_roots(long long[:] parent):
+    cdef Py_ssize_t i
+    with nogil:
+        for i in range(parent.shape[0]):
+            parent[i] = uf_find(parent, i)
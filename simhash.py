@@ -2,7 +2,10 @@
 # locally sensitive hashing code
 #
 
+import os
+import json
 from collections import defaultdict
+from itertools import chain, combinations
 import numpy as np
 import mmh3
 
@@ -13,6 +16,13 @@ import simcore as csimcore
 def murmur(x):
     return np.uint64(mmh3.hash(x, signed=False))
 
+# hash features in bulk, each distinct feature only once (wide fills all 64 bits, else only the low 32)
+def murmur_array(features, wide=False):
+    uniq, inv = np.unique(np.asarray(features, dtype=str), return_inverse=True)
+    hasher = (lambda f: mmh3.hash64(f, signed=False)[0]) if wide else (lambda f: mmh3.hash(f, signed=False))
+    hashes = np.fromiter(map(hasher, uniq), dtype=np.uint64, count=len(uniq))
+    return hashes[inv]
+
 # compute actual simhash
 class Simhash:
     def __init__(self):
@@ -38,6 +48,7 @@ class Simhash:
 class CSimhash():
     def __init__(self):
         self.simcore = csimcore.simcore
+        self.simcore_batch = csimcore.simcore_batch
 
     def simhash(self, features, weights=None):
         if weights is None:
@@ -46,6 +57,30 @@ class CSimhash():
         ret = np.uint64(self.simcore(hashish, weights))
         return ret
 
+    # sign many feature lists at once, returns uint64 array
+    def simhash_batch(self, features, weights=None, batch_size=1_000_000, wide=False):
+        sigs = []
+        for i in range(0, len(features), batch_size):
+            feats = features[i:i+batch_size]
+
+            # flatten with per-name offsets
+            lens = np.fromiter(map(len, feats), dtype=np.int64, count=len(feats))
+            offsets = np.concatenate([[0], np.cumsum(lens)]).astype(np.int64)
+            hashes = murmur_array(list(chain.from_iterable(feats)), wide=wide)
+
+            # flatten weights
+            if weights is None:
+                wvec = np.ones(len(hashes), dtype=np.float32)
+            else:
+                wvec = np.fromiter(chain.from_iterable(weights[i:i+batch_size]), dtype=np.float32, count=len(hashes))
+
+            # vote bits in compiled kernel
+            sigs.append(self.simcore_batch(hashes, wvec, offsets))
+
+        if len(sigs) == 0:
+            return np.zeros(0, dtype=np.uint64)
+        return np.concatenate(sigs)
+
 class Cluster:
     # dim is the simhash width, k is the tolerance
     def __init__(self, dim=64, k=4, thresh=1):
@@ -54,6 +89,7 @@ class Cluster:
         self.thresh = thresh
 
         self.unions = []
+        self.sigs = None
         self.hashmaps = [defaultdict(list) for _ in range(k)]
         self.offsets = [np.uint64(dim//k*i) for i in range(k)]
         self.bin_masks = [np.uint64(2**(dim-offset)-1) if (i == len(self.offsets)-1) else np.uint64(2**(self.offsets[i+1]-offset)-1) for (i, offset) in enumerate(self.offsets)]
@@ -81,3 +117,116 @@ class Cluster:
     # bin simhash into chunks
     def get_keys(self, simhash):
         return [simhash >> offset & mask for (offset, mask) in zip(self.offsets, self.bin_masks)]
+
+    # bulk build from signature array, bands stored as sorted key arrays
+    def build(self, sigs, labels=None):
+        self.sigs = np.asarray(sigs, dtype=np.uint64)
+        self.labels = np.arange(len(self.sigs)) if labels is None else np.asarray(labels)
+        self.band_keys = []
+        self.band_index = []
+        for offset, mask in zip(self.offsets, self.bin_masks):
+            keys = (self.sigs >> offset) & mask
+            order = np.argsort(keys, kind='stable')
+            self.band_keys.append(keys[order])
+            self.band_index.append(order)
+
+    # cluster ids for built signatures, linking names that share more than thresh bands
+    def components(self):
+        parent = np.arange(len(self.sigs), dtype=np.int64)
+
+        # sharing thresh+1 bands means agreeing on all bits of some (thresh+1)-subset of bands
+        for bands in combinations(range(self.k), self.thresh+1):
+            if len(bands) == 1:
+                keys, order = self.band_keys[bands[0]], self.band_index[bands[0]]
+            else:
+                mask = np.uint64(0)
+                for b in bands:
+                    mask |= self.bin_masks[b] << self.offsets[b]
+                keys = self.sigs & mask
+                order = np.argsort(keys)
+                keys = keys[order]
+
+            # sort-and-scan: link neighbors in runs of equal keys
+            same = keys[1:] == keys[:-1]
+            csimcore.uf_union(parent, order[1:][same], order[:-1][same])
+
+        # compress roots to consecutive cluster ids
+        csimcore.uf_roots(parent)
+        _, cids = np.unique(parent, return_inverse=True)
+        return cids
+
+    # near-duplicate stored labels for each query signature, index is not modified
+    def query(self, sigs):
+        sigs = np.asarray(sigs, dtype=np.uint64)
+        n = len(self.sigs)
+        if n == 0 or len(sigs) == 0:
+            return [self.labels[:0] for _ in sigs]
+
+        # candidate positions from binary search in each band
+        qidx, cand = [], []
+        for keys, index, offset, mask in zip(self.band_keys, self.band_index, self.offsets, self.bin_masks):
+            qkeys = (sigs >> offset) & mask
+            lo = np.searchsorted(keys, qkeys, side='left')
+            hi = np.searchsorted(keys, qkeys, side='right')
+            lens = hi - lo
+            pos = np.arange(lens.sum()) - np.repeat(np.cumsum(lens) - lens - lo, lens)
+            qidx.append(np.repeat(np.arange(len(sigs)), lens))
+            cand.append(index[pos])
+
+        # keep candidates sharing more than thresh bands
+        codes, counts = np.unique(np.concatenate(qidx)*n + np.concatenate(cand), return_counts=True)
+        q, c = np.divmod(codes[counts > self.thresh], n)
+
+        # group by query
+        splits = np.searchsorted(q, np.arange(1, len(sigs)))
+        return [self.labels[c1] for c1 in np.split(c, splits)]
+
+    # add signatures to a built index, keeping bands sorted
+    def append(self, sigs, labels):
+        if self.sigs is None:
+            return self.build(sigs, labels)
+
+        sigs = np.asarray(sigs, dtype=np.uint64)
+        base = len(self.sigs)
+        pos = np.arange(base, base + len(sigs))
+
+        # merge new keys after equal existing ones
+        for b, (offset, mask) in enumerate(zip(self.offsets, self.bin_masks)):
+            keys = (sigs >> offset) & mask
+            order = np.argsort(keys, kind='stable')
+            at = np.searchsorted(self.band_keys[b], keys[order], side='right')
+            self.band_keys[b] = np.insert(self.band_keys[b], at, keys[order])
+            self.band_index[b] = np.insert(self.band_index[b], at, pos[order])
+
+        self.sigs = np.concatenate([self.sigs, sigs])
+        self.labels = np.concatenate([self.labels, np.asarray(labels)])
+
+    # save built index as .npy arrays (labels must be numeric or str, not objects)
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        arrays = {'sigs': self.sigs, 'labels': self.labels}
+        for b in range(self.k):
+            arrays[f'keys{b}'] = self.band_keys[b]
+            arrays[f'index{b}'] = self.band_index[b]
+
+        # replace files atomically so existing memory maps stay valid
+        for name, arr in arrays.items():
+            temp = os.path.join(path, f'{name}.tmp.npy')
+            np.save(temp, arr)
+            os.replace(temp, os.path.join(path, f'{name}.npy'))
+
+        with open(os.path.join(path, 'meta.json'), 'w') as fid:
+            json.dump({'dim': self.dim, 'k': self.k, 'thresh': self.thresh}, fid)
+
+    # load saved index, memory-mapped by default so processes can share it
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        with open(os.path.join(path, 'meta.json')) as fid:
+            meta = json.load(fid)
+        c = cls(**meta)
+        array = lambda name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode=mmap_mode)
+        c.sigs = array('sigs')
+        c.labels = array('labels')
+        c.band_keys = [array(f'keys{b}') for b in range(c.k)]
+        c.band_index = [array(f'index{b}') for b in range(c.k)]
+        return c
@@ -1,10 +1,22 @@
 # generate similarity metrics
 
+import os
+import json
+import shutil
+import hashlib
+import time
 import torch
+import numpy as np
 import pandas as pd
 from ziggy import TextDatabase, TorchVectorIndex
 from ziggy.quant import Half
 from ziggy.utils import batch_indices
+from queue import Queue
+from threading import Thread
+from quantize import QuantIndex, QuantVectors, load_store, quantize, matmul_t, to_compute
+
+# bytes of comparison block (plus sims) to keep in cache
+cache_bytes = 2*2**20
 
 # merge multiple text databases (assumes same qspec, ignores groups)
 def merge_databases(paths, output, model, qspec=Half, size=1024):
@@ -18,14 +30,77 @@ def merge_databases(paths, output, model, qspec=Half, size=1024):
         del db1
     db.save(output)
 
+# merge text databases into a store directory without growing an index in memory: vectors
+# and labels go into preallocated .npy files block by block, text is streamed to jsonl
+def merge_stream(paths, output, model=None, chunk=1_000_000):
+    # sizes only (vectors memory-mapped, not read)
+    sizes, dims, width = [], set(), 1
+    for path in paths:
+        index = load_database(path, mmap=True)
+        sizes.append(len(index))
+        dims.add(index.values.data.shape[1])
+        width = max([width] + [len(str(s)) for s in index.labels])
+        del index
+    if len(dims) != 1:
+        raise Exception(f'Inconsistent dimensions: {dims}')
+    dim, total = dims.pop(), sum(sizes)
+    print(f'Merging {total} vectors of dimension {dim} from {len(paths)} databases')
+
+    # preallocate outputs in temporary directory
+    path_tmp = f'{output}.tmp'
+    os.makedirs(path_tmp, exist_ok=True)
+    values = np.lib.format.open_memmap(os.path.join(path_tmp, 'values.npy'), mode='w+', dtype=np.float16, shape=(total, dim))
+    labels = np.lib.format.open_memmap(os.path.join(path_tmp, 'labels.npy'), mode='w+', dtype=f'U{width}', shape=(total,))
+
+    # copy one source at a time
+    o1 = 0
+    with open(os.path.join(path_tmp, 'text.jsonl'), 'w') as fid:
+        for path, size in zip(paths, sizes):
+            print(f'Copying {path} ({size})')
+            db1 = TextDatabase.load(path, embed=model, device='cpu')
+            vectors = db1.index.values.data
+            for c1, c2 in batch_indices(size, chunk):
+                values[o1+c1:o1+c2] = vectors[c1:c2].to(device='cpu', dtype=torch.float16).numpy()
+            labels[o1:o1+size] = [str(s) for s in db1.index.labels]
+            for label, text in db1.text.items():
+                fid.write(json.dumps({'label': str(label), 'text': text}, ensure_ascii=False) + '\n')
+            o1 += size
+            del db1, vectors
+
+    # finalize and move into place
+    values.flush()
+    labels.flush()
+    del values, labels
+    with open(os.path.join(path_tmp, 'meta.json'), 'w') as fid:
+        json.dump({'dim': dim, 'size': total, 'sources': list(paths)}, fid)
+    if os.path.exists(output):
+        shutil.rmtree(output)
+    os.replace(path_tmp, output)
+
 # demean and renormalize vectors
 def demean_inplace(x):
+    if isinstance(x, QuantVectors):
+        raise Exception('Quantized vectors cannot be demeaned, quantize with demean=True instead')
     x -= x.mean(dim=0)[None,:]
     x /= x.square().sum(dim=1)[:,None]
 
-# load ziggy TorchVectorIndex directly or from TextDatabase
-def load_database(path):
-    data = torch.load(path)
+# column mean accumulated over row chunks (so memory-mapped vectors are read once, not copied)
+def chunk_mean(x, chunk=1_000_000):
+    total = torch.zeros(x.shape[1], dtype=torch.float64)
+    for c1, c2 in batch_indices(len(x), chunk):
+        total += x[c1:c2].to(device='cpu', dtype=torch.float64).sum(dim=0)
+    return total / len(x)
+
+# demean_inplace for a block of rows given the full column mean
+def demean_rows(x, mean):
+    x = x - mean[None,:]
+    return x / x.square().sum(dim=1)[:,None]
+
+# load ziggy TorchVectorIndex directly or from TextDatabase (or store directory)
+def load_database(path, mmap=False):
+    if os.path.isdir(path):
+        return load_store(path)
+    data = torch.load(path, mmap=mmap)
     if 'index' in data:
         data = data['index']
     return TorchVectorIndex.load(data)
@@ -54,75 +129,389 @@ def merge_patents(
     # save ordered patent data
     pats.to_csv(path_pats, index=False)
 
-def similarity_topk(
-    path_vecs, # ziggy database
-    path_pats, # patent metadata csv (for comparison!)
-    path_sims, # output torch file
-    path_vecs1=None, # comparison ziggy database
-    topk=100, batch_size=256, max_rows=None, demean=False
+# raw vectors of ziggy index or store
+def index_vectors(index):
+    return index.values.data if isinstance(index, TorchVectorIndex) else index.vectors
+
+# convert ziggy database to int8 store, reporting similarity drift against fp32 on a sample
+def quantize_database(path, output, mode='vector', demean=False, chunk=1_000_000, sample=2000, seed=0):
+    print(f'Loading {path}')
+    index = load_database(path)
+    data = index_vectors(index)
+    if demean:
+        demean_inplace(data)
+
+    # per-dimension scales need a pass over everything first
+    scale = None
+    if mode == 'dim':
+        amax = torch.stack([data[c1:c2].float().abs().amax(dim=0) for c1, c2 in batch_indices(len(data), chunk)])
+        scale = (amax.amax(dim=0, keepdim=True) / 127).clamp(min=1e-12).cpu()
+
+    # quantize in chunks
+    quant = [quantize(data[c1:c2].cpu(), mode=mode, scale=scale) for c1, c2 in batch_indices(len(data), chunk)]
+    values = torch.cat([q.values for q in quant])
+    scale = torch.cat([q.scale for q in quant]) if mode == 'vector' else scale
+    qindex = QuantIndex(index.labels, QuantVectors(values, scale, mode))
+    qindex.save(output)
+    print(f'Saved {len(qindex)} vectors to {output} ({values.numel()/2**20:.0f} MB)')
+
+    # pairwise similarity drift on a sample
+    gen = torch.Generator().manual_seed(seed)
+    rows = torch.randperm(len(data), generator=gen)[:sample]
+    exact = data[rows.to(data.device)].float().cpu()
+    approx = to_compute(qindex.vectors[rows], 'cpu', torch.int8)
+    err = (matmul_t(approx, approx) - exact @ exact.T).abs()
+    print(f'similarity drift: mean = {err.mean():.2e}, max = {err.max():.2e}')
+
+    return qindex
+
+# resolve compute dtype (fp16 matmul is slow on cpu, so default to fp32 there; int8 for integer matmul)
+def compute_dtype(device, dtype=None):
+    if dtype is None:
+        return torch.float16 if torch.device(device).type == 'cuda' else torch.float32
+    return getattr(torch, dtype) if type(dtype) is str else dtype
+
+# comparison block width so [W, D] vectors and [B, W] sims fit in cache
+def cache_block(dim, batch_size, dtype):
+    width = cache_bytes // (dim*dtype.itemsize + batch_size*4)
+    return max(256, width // 256 * 256)
+
+# similarities of query vecs against base in column blocks: yields (j1, j2, [B, W] sims)
+def block_sims(vecs, base, block_size):
+    for j1, j2 in batch_indices(len(base), block_size):
+        yield j1, j2, matmul_t(vecs, to_compute(base[j1:j2], vecs.device, vecs.dtype))
+
+# output arrays: name -> (shape, dtype name)
+def topk_arrays(n_pats, topk):
+    return {'top_idx': ((n_pats, topk), 'int32'), 'top_sim': ((n_pats, topk), 'float16')}
+
+def mean_arrays(n_pats, n_years):
+    return {'year_sim': ((n_pats, n_years), 'float16')}
+
+# result arrays held in (device) memory
+class TensorWriter:
+    def __init__(self, arrays, device='cuda'):
+        self.start = 0
+        self.arrays = {
+            k: torch.zeros(shape, dtype=getattr(torch, dtype), device=device)
+            for k, (shape, dtype) in arrays.items()
+        }
+
+    # store rows i1:i2 (or the given row indices) of each array
+    def write(self, i1, i2, rows=None, **vals):
+        for k, v in vals.items():
+            arr = self.arrays[k]
+            idx = slice(i1, i2) if rows is None else torch.as_tensor(rows, device=arr.device)
+            arr[idx] = v.to(device=arr.device, dtype=arr.dtype)
+
+    def close(self):
+        pass
+
+# result arrays in preallocated memory-mapped .npy files, written on a background thread
+# as batches finish, with a progress marker so a rerun can skip completed rows
+class NpyWriter:
+    def __init__(self, path, arrays, resume=False, queue_size=2, **meta):
+        self.path = path
+        self.meta = {'arrays': {k: [list(shape), dtype] for k, (shape, dtype) in arrays.items()}, **meta}
+        self.error = None
+        self.closed = False
+
+        # reopen existing outputs if they match this job
+        state = self.load_progress() if resume else None
+        if state is not None:
+            self.start = state['rows']
+            print(f'Resuming {path} at row {self.start}')
+            self.arrays = {k: np.load(self.array_path(k), mmap_mode='r+') for k in arrays}
+        else:
+            self.start = 0
+            self.arrays = {
+                k: np.lib.format.open_memmap(self.array_path(k), mode='w+', dtype=dtype, shape=shape)
+                for k, (shape, dtype) in arrays.items()
+            }
+            self.save_progress(0)
+
+        # bounded queue so compute only waits if the writer falls far behind
+        self.queue = Queue(maxsize=queue_size)
+        self.thread = Thread(target=self.worker, daemon=True)
+        self.thread.start()
+
+    def array_path(self, name):
+        return f'{self.path}.{name}.npy'
+
+    def progress_path(self):
+        return f'{self.path}.progress'
+
+    def save_progress(self, rows):
+        path = self.progress_path()
+        with open(f'{path}.tmp', 'w') as fid:
+            json.dump({'rows': rows, **self.meta}, fid)
+        os.replace(f'{path}.tmp', path)
+
+    # progress marker if it matches this job and its arrays exist
+    def load_progress(self):
+        path = self.progress_path()
+        if not os.path.exists(path) or not all(os.path.exists(self.array_path(k)) for k in self.meta['arrays']):
+            return None
+        with open(path) as fid:
+            state = json.load(fid)
+        if {k: v for k, v in state.items() if k != 'rows'} != self.meta:
+            return None
+        return state
+
+    # hand rows i1:i2 (or the given row indices) to writer thread
+    def write(self, i1, i2, rows=None, **vals):
+        self.check()
+        vals = {k: v.cpu().numpy() if torch.is_tensor(v) else v for k, v in vals.items()}
+        self.queue.put((i2, slice(i1, i2) if rows is None else rows, vals))
+
+    # runs on writer thread, marking progress once rows are flushed
+    def worker(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if self.error is not None:
+                continue
+            try:
+                i2, rows, vals = item
+                for k, v in vals.items():
+                    self.arrays[k][rows] = v
+                    self.arrays[k].flush()
+                self.save_progress(i2)
+            except Exception as e:
+                self.error = e
+
+    # raise writer thread errors in producer
+    def check(self):
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(None)
+        self.thread.join()
+        self.check()
+
+# in-memory results, or checkpointed .npy files next to path_sims
+def open_results(path_sims, arrays, device='cuda', checkpoint=False, resume=False, **meta):
+    if checkpoint or resume:
+        return NpyWriter(path_sims, arrays, resume=resume, **meta)
+    return TensorWriter(arrays, device=device)
+
+# finish writing and save results (plus extra tensors) to torch file
+def save_results(path_sims, out, **extra):
+    out.close()
+    data = {k: torch.as_tensor(v) for k, v in out.arrays.items()}
+    torch.save({**data, **extra}, path_sims)
+
+# merge new candidates into running top-k
+def merge_topk(vals, idxs, vals1, idxs1, k):
+    vals, idxs = torch.cat([vals, vals1], dim=1), torch.cat([idxs, idxs1], dim=1)
+    top = vals.topk(k, dim=1)
+    return top.values, idxs.gather(1, top.indices)
+
+# top-k most similar earlier base vectors for each query vector
+def topk_blocked(
+    query, base, # [N, D] query and [M, D] comparison vectors
+    days_q, days_b, # application days for query and comparison rows
+    topk=100, batch_size=256, block_size=None, device='cuda', dtype=None, out=None
 ):
-    # load vector index
-    print('Loading vector index')
-    index = load_database(path_vecs)
-    n_pats = len(index)
+    dtype = compute_dtype(device, dtype)
+    if block_size is None:
+        block_size = cache_block(base.shape[1], batch_size, dtype)
+    days_q, days_b = days_q.to(device), days_b.to(device)
 
-    # load comparison vector index
-    if path_vecs1 is not None:
-        print('Loading comparison vector index')
-        index1 = load_database(path_vecs1)
+    # create output tensors
+    n_pats = len(query)
+    if out is None:
+        out = TensorWriter(topk_arrays(n_pats, topk), device=device)
 
-    # demean vectors is requested
-    if demean:
-        demean_inplace(index.values.data)
-        if index1 is not index:
-            demean_inplace(index1.values.data)
+    # generate similarity metrics
+    for i1, i2 in batch_indices(n_pats, batch_size):
+        if i2 <= out.start:
+            continue
+        print(f'{i1} → {i2}')
+        n_batch = i2 - i1
 
-    # limit rows if requested
-    if max_rows is not None:
-        n_pats = min(n_pats, max_rows)
+        # running top sims for before
+        vecs = to_compute(query[i1:i2], device, dtype) # [B, D]
+        vals = torch.full((n_batch, topk), -torch.inf, device=device)
+        idxs = torch.zeros((n_batch, topk), dtype=torch.int64, device=device)
+        for j1, j2, sims in block_sims(vecs, base, block_size):
+            before = days_b[None, j1:j2] < days_q[i1:i2, None]
+            simb = torch.where(before, sims.float(), -torch.inf)
+            topb = simb.topk(min(topk, j2-j1), dim=1)
+            vals, idxs = merge_topk(vals, idxs, topb.values, topb.indices + j1, topk)
 
-    # load merged patent data
-    pats = pd.read_csv(path_pats, nrows=max_rows)
+        # store in output tensors
+        out.write(i1, i2, top_idx=idxs, top_sim=vals)
+
+    return out.arrays['top_idx'], out.arrays['top_sim']
 
-    # convert date to days since unix epoch
-    epoch = pd.to_datetime('1970-01-01')
-    dates = pats.set_index('patnum')['appdate']
-    days = torch.tensor((dates-epoch).dt.days.to_numpy(), device='cuda')
+# mean similarity to base vectors by application year for each query vector
+def mean_blocked(
+    query, base, # [N, D] query and [M, D] comparison vectors
+    year_idx, n_years, # year offset of comparison rows
+    batch_size=64, block_size=None, device='cuda', dtype=None, out=None
+):
+    dtype = compute_dtype(device, dtype)
+    if block_size is None:
+        block_size = cache_block(base.shape[1], batch_size, dtype)
+    year_idx = year_idx.to(device=device, dtype=torch.int64)
+    c_years = torch.bincount(year_idx, minlength=n_years)
 
     # create output tensors
-    idxt = torch.zeros((n_pats, topk), dtype=torch.int32, device='cuda')
-    simt = torch.zeros((n_pats, topk), dtype=torch.float16, device='cuda')
+    n_pats = len(query)
+    if out is None:
+        out = TensorWriter(mean_arrays(n_pats, n_years), device=device)
 
     # generate similarity metrics
     for i1, i2 in batch_indices(n_pats, batch_size):
+        if i2 <= out.start:
+            continue
         print(f'{i1} → {i2}')
 
-        # compute similarities for batch
-        vecs = index.values.data[i1:i2] # [B, D]
-        sims = index.similarity(vecs) # [B, N1]
-
-        # compute top sims for before
-        before = days[None, :] < days[i1:i2, None]
-        simb = torch.where(before, sims, -torch.inf)
-        topb = simb.topk(topk, dim=1)
+        # group sum by application year
+        vecs = to_compute(query[i1:i2], device, dtype) # [B, D]
+        sums = torch.zeros((i2-i1, n_years), dtype=torch.float32, device=device)
+        for j1, j2, sims in block_sims(vecs, base, block_size):
+            sums.index_add_(1, year_idx[j1:j2], sims.float())
+        out.write(i1, i2, year_sim=sums / c_years[None,:])
+
+    return out.arrays['year_sim'], c_years
+
+# mean similarity by year in closed form: mean_j(q . v_j) = q . sum_j(v_j) / count
+def mean_sums(
+    query, base, # [N, D] query and [M, D] comparison vectors
+    year_idx, n_years, # year offset of comparison rows
+    batch_size=65536, block_size=65536, device='cuda', out=None
+):
+    year_idx = year_idx.to(device=device, dtype=torch.int64)
+    c_years = torch.bincount(year_idx, minlength=n_years)
 
-        # store in output tensors
-        idxt[i1:i2] = topb.indices
-        simt[i1:i2] = topb.values
+    # per-year vector sums [Y, D], accumulated in double over comparison blocks
+    sums = torch.zeros((n_years, base.shape[1]), dtype=torch.float64, device=device)
+    for j1, j2 in batch_indices(len(base), block_size):
+        sums.index_add_(0, year_idx[j1:j2], base[j1:j2].to(device=device, dtype=torch.float64))
+    means = (sums / c_years[:,None]).float()
 
-    # save to disk
-    torch.save({
-        'top_idx': idxt,
-        'top_sim': simt,
-    }, path_sims)
+    # create output tensors
+    n_pats = len(query)
+    if out is None:
+        out = TensorWriter(mean_arrays(n_pats, n_years), device=device)
 
-def similarity_mean(
-    path_vecs, # ziggy database
-    path_pats, # patent metadata csv (for comparison!)
-    path_sims, # output torch file
-    path_vecs1=None, # comparison ziggy database
-    batch_size=64, max_rows=None, demean=False,
+    # generate similarity metrics
+    for i1, i2 in batch_indices(n_pats, batch_size):
+        if i2 <= out.start:
+            continue
+        print(f'{i1} → {i2}')
+        vecs = query[i1:i2].to(device=device, dtype=torch.float32) # [B, D]
+        out.write(i1, i2, year_sim=vecs @ means.T)
+
+    return out.arrays['year_sim'], c_years
+
+# top n_probe lists by centroid similarity for each vector
+def assign_lists(vecs, cents, n_probe=1, block_size=65536, device='cuda', dtype=None):
+    dtype = compute_dtype(device, dtype)
+    if dtype == torch.int8:
+        dtype = torch.float32
+    cents = cents.to(device=device, dtype=dtype)
+    n_probe = min(n_probe, len(cents))
+    lists = torch.zeros((len(vecs), n_probe), dtype=torch.int64, device=device)
+    for i1, i2 in batch_indices(len(vecs), block_size):
+        sims = vecs[i1:i2].to(device=device, dtype=dtype) @ cents.T
+        lists[i1:i2] = sims.float().topk(n_probe, dim=1).indices
+    return lists
+
+# spherical k-means centroids on a sample of base vectors (ivf coarse quantizer)
+def train_lists(base, n_lists, n_iter=10, sample=64, device='cuda', dtype=None, seed=0):
+    gen = torch.Generator().manual_seed(seed)
+    n_samp = min(len(base), n_lists*sample)
+    rows = torch.randperm(len(base), generator=gen)[:n_samp]
+    data = base[rows.to(base.device)].to(device=device, dtype=torch.float32)
+    data /= data.norm(dim=1, keepdim=True).clamp(min=1e-12)
+
+    # init at random sample rows
+    cents = data[torch.randperm(n_samp, generator=gen)[:n_lists].to(device)].clone()
+    for it in range(n_iter):
+        lists = assign_lists(data, cents, device=device, dtype=dtype)[:,0]
+        sums = torch.zeros_like(cents).index_add_(0, lists, data)
+        counts = torch.bincount(lists, minlength=n_lists)
+
+        # reseed empty lists with random sample rows
+        empty = (counts == 0).nonzero()[:,0]
+        sums[empty] = data[torch.randint(n_samp, (len(empty),), generator=gen).to(device)]
+        cents = sums / sums.norm(dim=1, keepdim=True).clamp(min=1e-12)
+
+    return cents
+
+# approximate top-k: shortlist base rows in the n_probe nearest lists, then re-rank exactly
+def topk_ivf(
+    query, base, # [N, D] query and [M, D] comparison vectors
+    days_q, days_b, # application days for query and comparison rows
+    topk=100, n_lists=None, n_probe=8, cents=None,
+    batch_size=4096, device='cuda', dtype=None
 ):
+    dtype = compute_dtype(device, dtype)
+    days_q, days_b = days_q.to(device), days_b.to(device)
+    n_pats, n_base = len(query), len(base)
+
+    # coarse quantizer, default about sqrt(M) lists
+    if cents is None:
+        n_lists = n_lists or max(1, int(np.sqrt(n_base)))
+        print(f'Training {n_lists} lists')
+        cents = train_lists(base, n_lists, device=device, dtype=dtype)
+    n_lists = len(cents)
+    n_probe = min(n_probe, n_lists)
+
+    # group base rows by list
+    base_list = assign_lists(base, cents, device=device, dtype=dtype)[:,0]
+    base_order = torch.argsort(base_list, stable=True)
+    base_start = torch.cumsum(torch.bincount(base_list, minlength=n_lists), 0).cpu().tolist()
+
+    # group (query, probe) pairs by list
+    probes = assign_lists(query, cents, n_probe=n_probe, device=device, dtype=dtype).ravel()
+    probe_rows = torch.arange(n_pats, device=device).repeat_interleave(n_probe)
+    probe_order = torch.argsort(probes, stable=True)
+    probe_start = torch.cumsum(torch.bincount(probes, minlength=n_lists), 0).cpu().tolist()
+
+    # running top sims for each query
+    vals = torch.full((n_pats, topk), -torch.inf, device=device)
+    idxs = torch.zeros((n_pats, topk), dtype=torch.int64, device=device)
+
+    # exact re-rank within each list for the queries probing it
+    for c in range(n_lists):
+        b1, b2 = base_start[c-1] if c > 0 else 0, base_start[c]
+        p1, p2 = probe_start[c-1] if c > 0 else 0, probe_start[c]
+        if b1 == b2 or p1 == p2:
+            continue
+        if c % 100 == 0:
+            print(f'list {c}/{n_lists}')
+
+        # list members once, queries in chunks
+        members = base_order[b1:b2]
+        mvecs = to_compute(base[members.to(base.device)], device, dtype) # [L, D]
+        mdays = days_b[members]
+        for r1, r2 in batch_indices(p2 - p1, batch_size):
+            rows = probe_rows[probe_order[p1+r1:p1+r2]]
+            vecs = to_compute(query[rows.to(query.device)], device, dtype) # [R, D]
+            before = mdays[None,:] < days_q[rows,None]
+            sims = torch.where(before, matmul_t(vecs, mvecs).float(), -torch.inf)
+            topb = sims.topk(min(topk, b2-b1), dim=1)
+            vals[rows], idxs[rows] = merge_topk(vals[rows], idxs[rows], topb.values, members[topb.indices], topk)
+
+    return idxs.to(torch.int32), vals.half()
+
+# fraction of each row's (finite) exact top-k found in the approximate top-k
+def topk_recall(idx_exact, sim_exact, idx_approx):
+    hits = (idx_exact[:,:,None] == idx_approx[:,None,:]).any(dim=2)
+    valid = sim_exact.isfinite()
+    return (hits & valid).sum().item() / max(1, valid.sum().item())
+
+# load (optionally demeaned) query and comparison vectors plus their metadata
+def load_inputs(path_vecs, path_pats, path_vecs1=None, max_rows=None, demean=False):
     # load vector index
     print('Loading base vector index')
     index = load_database(path_vecs)
@@ -138,54 +527,321 @@ def similarity_mean(
 
     # demean vectors is requested
     if demean:
-        demean_inplace(index.values.data)
+        demean_inplace(index_vectors(index))
         if index1 is not index:
-            demean_inplace(index1.values.data)
+            demean_inplace(index_vectors(index1))
 
     # limit rows if requested
     if max_rows is not None:
         n_pats = min(n_pats, max_rows)
 
     # load merged patent data
-    print('Loading patent metadata')
-    pats = pd.read_csv(path_pats)
-    pats['appdate'] = pd.to_datetime(pats['appdate']).fillna(pd.Timestamp('1970-01-01'))
-    print(f'Loaded {len(pats)} metadata')
+    pats = load_patents(path_pats, nrows=n_pats)
 
-    # get application year for patents
-    app_year = torch.tensor(pats['appdate'].dt.year, dtype=torch.int32, device='cuda')
-    year_min, year_max = app_year.min(), app_year.max()
-    year_idx = app_year - year_min
+    return index_vectors(index)[:n_pats], index_vectors(index1)[:n_pats], pats
 
-    # get application year statistics
-    n_years = year_max - year_min + 1
-    c_years = torch.bincount(year_idx, minlength=n_years)
+# load merged patent data with parsed application dates
+def load_patents(path_pats, nrows=None, usecols=None):
+    print('Loading patent metadata')
+    pats = pd.read_csv(path_pats, nrows=nrows, usecols=usecols)
+    pats['appdate'] = pd.to_datetime(pats['appdate'], errors='coerce').fillna(pd.Timestamp('1970-01-01'))
+    print(f'Loaded {len(pats)} metadata')
+    return pats
+
+# application date as days since unix epoch
+def app_days(pats):
+    epoch = pd.Timestamp('1970-01-01')
+    return (pats['appdate']-epoch).dt.days.to_numpy()
+
+# cached copy of index vectors in appdate order
+def sorted_path(path_vecs, demean=False):
+    return f'{path_vecs}.sorted{".demean" if demean else ""}.npy'
+
+# write index vectors in the given order to a .npy file for memory-mapped streaming
+def write_sorted(path_vecs, order, path_npy, demean=False, chunk=1_000_000):
+    print(f'Writing sorted vectors: {path_npy}')
+    index = load_database(path_vecs, mmap=True)
+    data = index_vectors(index)
+    if demean:
+        if isinstance(data, QuantVectors):
+            raise Exception('Quantized vectors cannot be demeaned, quantize with demean=True instead')
+        mean = chunk_mean(data, chunk)
+
+    # gather rows in chunks through a memmap and rename into place once complete
+    path_tmp = f'{path_npy}.tmp'
+    out = np.lib.format.open_memmap(path_tmp, mode='w+', dtype=np.float16, shape=(len(order), data.shape[1]))
+    for c1, c2 in batch_indices(len(order), chunk):
+        block = data[torch.from_numpy(order[c1:c2])].to(device='cpu', dtype=torch.float32)
+        if demean:
+            block = demean_rows(block, mean)
+        out[c1:c2] = block.half().numpy()
+    out.flush()
+    del out, index
+    os.replace(path_tmp, path_npy)
+
+    # record the order the rows were written in
+    with open(f'{path_npy}.json', 'w') as fid:
+        json.dump({'order': order_hash(order)}, fid)
+
+# hash of a row order, so a sorted copy is only reused for the same order
+def order_hash(order):
+    return hashlib.sha1(np.ascontiguousarray(order, dtype=np.int64).tobytes()).hexdigest()
+
+# memory-map sorted vectors, rebuilding if missing, stale, or written in another order
+def load_sorted(path_vecs, path_pats, order, demean=False):
+    path_npy = sorted_path(path_vecs, demean)
+    path_meta = f'{path_npy}.json'
+    if os.path.exists(path_npy) and os.path.exists(path_meta):
+        vecs = np.load(path_npy, mmap_mode='r')
+        stamp = max(os.path.getmtime(path_vecs), os.path.getmtime(path_pats))
+        with open(path_meta) as fid:
+            meta = json.load(fid)
+        if len(vecs) == len(order) and os.path.getmtime(path_npy) >= stamp and meta.get('order') == order_hash(order):
+            return vecs
+    write_sorted(path_vecs, order, path_npy, demean=demean)
+    return np.load(path_npy, mmap_mode='r')
+
+# top-k over date-sorted vectors, comparing each query block only to the earlier prefix
+def topk_sorted(
+    query, base, # [N, D] query and comparison vectors in appdate order (may be memory-mapped)
+    days, # sorted application days
+    order=None, # original row of each sorted row, to store results in original order
+    topk=100, batch_size=4096, tile_size=65536, device='cuda', dtype=None, out=None
+):
+    dtype = compute_dtype(device, dtype)
+    days_t = torch.from_numpy(days).to(device)
 
     # create output tensors
-    avgt = torch.zeros((n_pats, n_years), dtype=torch.float16, device='cuda')
+    n_pats = len(query)
+    if out is None:
+        out = TensorWriter(topk_arrays(n_pats, topk), device=device)
+    if order is None:
+        order = np.arange(n_pats)
+    order_t = torch.from_numpy(order).to(device)
 
     # generate similarity metrics
     for i1, i2 in batch_indices(n_pats, batch_size):
+        if i2 <= out.start:
+            continue
         print(f'{i1} → {i2}')
         n_batch = i2 - i1
 
-        # compute similarities for batch
-        vecs = index.values.data[i1:i2] # [B, D]
-        # sims = index1.similarity(vecs) # [B, N1]
-        sims = (index1.values.data[:n_pats,:] @ vecs.T).T # [B, N1]
+        # earlier rows end before the latest query date, and rows before the
+        # earliest query date are earlier for the whole block
+        end = np.searchsorted(days, days[i2-1], side='left')
+        low = np.searchsorted(days, days[i1], side='left')
+
+        # running top sims over prefix tiles
+        vecs = to_compute(torch.from_numpy(np.array(query[i1:i2])), device, dtype) # [B, D]
+        vals = torch.full((n_batch, topk), -torch.inf, device=device)
+        idxs = torch.zeros((n_batch, topk), dtype=torch.int64, device=device)
+        for j1, j2 in batch_indices(end, tile_size):
+            tile = to_compute(torch.from_numpy(np.array(base[j1:j2])), device, dtype) # [T, D]
+            sims = matmul_t(vecs, tile).float()
+            if j2 > low:
+                before = days_t[None, j1:j2] < days_t[i1:i2, None]
+                sims = torch.where(before, sims, -torch.inf)
+            topb = sims.topk(min(topk, j2-j1), dim=1)
+            vals, idxs = merge_topk(vals, idxs, topb.values, topb.indices + j1, topk)
+
+        # store rows and neighbor indices in original order
+        out.write(i1, i2, rows=order[i1:i2], top_idx=order_t[idxs], top_sim=vals)
+
+    return out.arrays['top_idx'], out.arrays['top_sim']
+
+# memory-mapped vectors in appdate order, with sorted days and original row order
+def load_sorted_inputs(path_vecs, path_pats, path_vecs1=None, max_rows=None, demean=False):
+    # sort by application date (stable, so ties keep index order)
+    pats = load_patents(path_pats, nrows=max_rows, usecols=['appdate'])
+    days = app_days(pats)
+    order = np.argsort(days, kind='stable')
+
+    # memory-mapped vectors in date order
+    query = load_sorted(path_vecs, path_pats, order, demean=demean)
+    base = query if path_vecs1 is None else load_sorted(path_vecs1, path_pats, order, demean=demean)
+
+    return query, base, days[order], order
 
-        # generate offsets
-        batch_vec = torch.arange(n_batch, device='cuda')
-        offsets = batch_vec[:,None] * n_years + year_idx[None,:]
+def similarity_topk(
+    path_vecs, # ziggy database
+    path_pats, # patent metadata csv (for comparison!)
+    path_sims, # output torch file
+    path_vecs1=None, # comparison ziggy database
+    topk=100, batch_size=None, max_rows=None, demean=False,
+    device='cuda', dtype=None, block_size=None, threads=None,
+    method='full', # 'full' (mask later rows), 'sorted' (stream earlier prefix from memory-mapped vectors) or 'ivf' (approximate)
+    n_lists=None, n_probe=8, # ivf lists (default about sqrt(N)) and lists probed per query
+    checkpoint=False, resume=False, # write .npy outputs as batches finish, skip rows already done
+):
+    if threads is not None:
+        torch.set_num_threads(threads)
+    if method == 'ivf' and (checkpoint or resume):
+        raise Exception('Checkpointing is not supported for ivf')
+
+    if method == 'full':
+        # load vectors and metadata
+        query, base, pats = load_inputs(path_vecs, path_pats, path_vecs1, max_rows, demean)
+        days = torch.tensor(app_days(pats), device=device)
+        out = open_results(path_sims, topk_arrays(len(query), topk), device, checkpoint, resume, method=method)
+
+        # generate similarity metrics
+        topk_blocked(
+            query, base, days, days, topk=topk, batch_size=batch_size or 256,
+            block_size=block_size, device=device, dtype=dtype, out=out
+        )
+    elif method == 'ivf':
+        # load vectors and metadata
+        query, base, pats = load_inputs(path_vecs, path_pats, path_vecs1, max_rows, demean)
+        days = torch.tensor(app_days(pats), device=device)
+        out = open_results(path_sims, topk_arrays(len(query), topk), device)
+
+        # shortlist by coarse quantizer and re-rank exactly
+        idxt, simt = topk_ivf(
+            query, base, days, days, topk=topk, n_lists=n_lists, n_probe=n_probe,
+            batch_size=batch_size or 4096, device=device, dtype=dtype
+        )
+        out.write(0, len(query), top_idx=idxt, top_sim=simt)
+    elif method == 'sorted':
+        # memory-mapped vectors in date order
+        query, base, days, order = load_sorted_inputs(path_vecs, path_pats, path_vecs1, max_rows, demean)
+        out = open_results(path_sims, topk_arrays(len(query), topk), device, checkpoint, resume, method=method)
+
+        # generate similarity metrics over date-sorted tiles
+        topk_sorted(
+            query, base, days, order=order, topk=topk, batch_size=batch_size or 4096,
+            tile_size=block_size or 65536, device=device, dtype=dtype, out=out
+        )
+    else:
+        raise Exception(f'Unsupported method: {method}')
 
-        # group sum by application year
-        sums = torch.bincount(offsets.ravel(), weights=sims.ravel(), minlength=n_batch*n_years)
-        avgt[i1:i2] = sums.reshape(n_batch, n_years) / c_years[None,:]
+    # save to disk
+    save_results(path_sims, out)
+
+def similarity_mean(
+    path_vecs, # ziggy database
+    path_pats, # patent metadata csv (for comparison!)
+    path_sims, # output torch file
+    path_vecs1=None, # comparison ziggy database
+    batch_size=None, max_rows=None, demean=False,
+    device='cuda', dtype=None, block_size=None, threads=None,
+    method='sums', # 'sums' (closed form) or 'blocked' (brute force, for verification)
+    checkpoint=False, resume=False, # write .npy outputs as batches finish, skip rows already done
+):
+    if threads is not None:
+        torch.set_num_threads(threads)
+
+    # load vectors and metadata
+    query, base, pats = load_inputs(path_vecs, path_pats, path_vecs1, max_rows, demean)
+
+    # get application year for patents
+    app_year = torch.tensor(pats['appdate'].dt.year.to_numpy(), dtype=torch.int32, device=device)
+    year_min, year_max = app_year.min(), app_year.max()
+    year_idx = app_year - year_min
+    n_years = int(year_max - year_min + 1)
+    out = open_results(
+        path_sims, mean_arrays(len(query), n_years), device, checkpoint, resume,
+        method=method, year_min=int(year_min)
+    )
+
+    # generate similarity metrics
+    if method == 'sums':
+        _, c_years = mean_sums(
+            query, base, year_idx, n_years, batch_size=batch_size or 65536,
+            block_size=block_size or 65536, device=device, out=out
+        )
+    elif method == 'blocked':
+        _, c_years = mean_blocked(
+            query, base, year_idx, n_years, batch_size=batch_size or 64,
+            block_size=block_size, device=device, dtype=dtype, out=out
+        )
+    else:
+        raise Exception(f'Unsupported method: {method}')
 
     # save to disk
-    torch.save({
-        'year_sim'  : avgt    ,
-        'year_count': c_years ,
-        'year_min'  : year_min,
-        'year_max'  : year_max,
-    }, path_sims)
+    save_results(path_sims, out, year_count=c_years, year_min=year_min, year_max=year_max)
+
+# recall@k of ivf top-k against exact top-k on a sample of query rows
+def similarity_recall(
+    path_vecs, # ziggy database
+    path_pats, # patent metadata csv (for comparison!)
+    path_vecs1=None, # comparison ziggy database
+    topk=100, sample=10_000, max_rows=None, demean=False,
+    n_lists=None, n_probes=(1, 2, 4, 8, 16, 32),
+    device='cuda', dtype=None, threads=None, seed=0,
+):
+    if threads is not None:
+        torch.set_num_threads(threads)
+
+    # load vectors and metadata
+    query, base, pats = load_inputs(path_vecs, path_pats, path_vecs1, max_rows, demean)
+    days = torch.tensor(app_days(pats))
+
+    # sample query rows
+    gen = torch.Generator().manual_seed(seed)
+    rows = torch.randperm(len(query), generator=gen)[:sample].sort().values
+    query1, days1 = query[rows.to(query.device)], days[rows]
+
+    # exact reference
+    time0 = time.time()
+    idx_exact, sim_exact = topk_blocked(query1, base, days1, days, topk=topk, device=device, dtype=dtype)
+    time_exact = time.time() - time0
+
+    # shared coarse quantizer
+    n_lists = n_lists or max(1, int(np.sqrt(len(base))))
+    cents = train_lists(base, n_lists, device=device, dtype=dtype)
+
+    # recall and relative time per probe count, up to probing every list
+    stats = []
+    for n_probe in n_probes:
+        if n_probe > len(cents):
+            print(f'n_probe = {n_probe}: skipped, only {len(cents)} lists')
+            continue
+        time0 = time.time()
+        idx_approx, _ = topk_ivf(query1, base, days1, days, topk=topk, cents=cents, n_probe=n_probe, device=device, dtype=dtype)
+        delta = time.time() - time0
+        recall = topk_recall(idx_exact, sim_exact, idx_approx)
+        stats.append((n_probe, recall, delta, time_exact/delta))
+        print(f'n_probe = {n_probe}: recall@{topk} = {recall:.4f}, {delta:.2f}s ({time_exact/delta:.1f}x exact)')
+
+    return pd.DataFrame(stats, columns=['n_probe', 'recall', 'time', 'speedup'])
+
+# top-k agreement and mean similarity drift of int8 store against fp32 on a sample of query rows
+def quant_drift(
+    path_vecs, # ziggy database
+    path_quant, # int8 store from quantize_database
+    path_pats, # patent metadata csv (for comparison!)
+    topk=100, sample=2000, max_rows=None, demean=False,
+    device='cuda', threads=None, seed=0,
+):
+    if threads is not None:
+        torch.set_num_threads(threads)
+
+    # run both stores on the same sampled query rows
+    stats = {}
+    for name, path, dtype in [('fp32', path_vecs, torch.float32), ('int8', path_quant, torch.int8)]:
+        query, base, pats = load_inputs(path, path_pats, max_rows=max_rows, demean=demean and name == 'fp32')
+        gen = torch.Generator().manual_seed(seed)
+        rows = torch.randperm(len(query), generator=gen)[:sample].sort().values
+        days = torch.tensor(app_days(pats))
+        year_idx = torch.tensor(pats['appdate'].dt.year.to_numpy()) - int(pats['appdate'].dt.year.min())
+        n_years = int(year_idx.max()) + 1
+
+        time0 = time.time()
+        idx, sim = topk_blocked(query[rows.to(query.device)], base, days[rows], days, topk=topk, device=device, dtype=dtype)
+        avg, _ = mean_blocked(query[rows.to(query.device)], base, year_idx, n_years, device=device, dtype=dtype)
+        stats[name] = (idx, sim, avg, time.time() - time0)
+        del query, base
+
+    # compare
+    idx0, sim0, avg0, time0 = stats['fp32']
+    idx1, sim1, avg1, time1 = stats['int8']
+    recall = topk_recall(idx0, sim0, idx1)
+    fin = sim0.isfinite() & sim1.isfinite()
+    sim_err = (sim0.float() - sim1.float())[fin].abs()
+    avg_err = (avg0.float() - avg1.float()).abs()
+    print(f'recall@{topk} = {recall:.4f}')
+    print(f'top sim drift: mean = {sim_err.mean():.2e}, max = {sim_err.max():.2e}')
+    print(f'year mean drift: mean = {avg_err.mean():.2e}, max = {avg_err.max():.2e}')
+    print(f'time: fp32 = {time0:.2f}s, int8 = {time1:.2f}s')
+
+    return {'recall': recall, 'sim_err': sim_err.max().item(), 'avg_err': avg_err.max().item()}
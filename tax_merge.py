@@ -1,7 +1,17 @@
+import os
+import gc
 import json
-import numpy as np
+import hashlib
+import argparse
+import resource
 import pandas as pd
 from glob import glob
+from multiprocessing import get_context
+
+parser = argparse.ArgumentParser(description='Merge firm tax survey years.')
+parser.add_argument('--low-memory', action='store_true', help='compact dtypes (float32 financials, small ints, categorical ids)')
+parser.add_argument('--workers', type=int, default=min(24, os.cpu_count()), help='year files to load in parallel')
+args = parser.parse_args()
 
 cols_basic0 = {
 	'year': 'year',
@@ -82,46 +92,138 @@ location = pd.read_csv('location_map.csv').set_index('from')['to'].to_dict()
 ## load data
 ##
 
-dtype = {'id': str}
-sconv = lambda s: int(s) if s.isdigit() else np.nan
-def load_year(fn, cols):
+# year file cache location
+cache_dir = 'original/cache'
+
+# compact integer types for low memory mode
+small_ints = {'year': 'Int16', 'loccode': 'Int32', 'industry_a': 'Int32', 'industry_b': 'Int32'}
+
+# peak resident memory so far, for this process and finished workers (linux reports KB)
+def report(stage):
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**20
+	child = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 2**20
+	print(f'{stage}: peak rss {peak:.2f} GB (workers {child:.2f} GB)')
+
+# digit strings to Int64, anything else missing
+def sconv(s):
+	isnum = s.str.isdigit().fillna(False).astype(bool)
+	return pd.to_numeric(s.where(isnum), errors='coerce').astype('Int64')
+
+# cache path keyed on source size, mtime, and columns
+def cache_path(fn, cols):
+	stat = os.stat(fn)
+	stem, _ = os.path.splitext(os.path.basename(fn))
+	chash = hashlib.md5(json.dumps(cols).encode()).hexdigest()[:8]
+	return os.path.join(cache_dir, f'{stem}-{stat.st_size}-{stat.st_mtime_ns}-{chash}.parquet'), stem
+
+def parse_year(fn, cols):
+	strs = ['id', 'year', 'UBI_7_a', 'UBI_7_b']
+	dtype = {k: str for k in strs if k in cols}
 	df = pd.read_csv(fn, dtype=dtype, usecols=cols).rename(cols, axis=1)
-	df['year'] = df['year'].apply(lambda s: s[:4]).apply(sconv).astype('Int64')
+	df['year'] = sconv(df['year'].str[:4])
 	if 'loccode' in df:
 		df['loccode'] = df['loccode'].astype('Int64')
+	for col in ['industry_a', 'industry_b']:
+		if col in df:
+			df[col] = sconv(df[col].str[1:])
+	return df
+
+# downcast numeric columns in place
+def compact(df):
+	for col in df.columns:
+		if col in small_ints:
+			df[col] = df[col].astype(small_ints[col])
+		elif df[col].dtype == 'float64':
+			df[col] = df[col].astype('float32')
+		elif df[col].dtype == 'int64':
+			df[col] = pd.to_numeric(df[col], downcast='integer')
+	return df
+
+def load_year(fn, cols, low_memory=False):
+	path, stem = cache_path(fn, cols)
+	if os.path.exists(path):
+		df = pd.read_parquet(path)
+	else:
+		df = parse_year(fn, cols)
+
+		# replace stale cache entries
+		os.makedirs(cache_dir, exist_ok=True)
+		for old in glob(os.path.join(cache_dir, f'{stem}-*.parquet')):
+			os.remove(old)
+		df.to_parquet(f'{path}.tmp', index=False)
+		os.replace(f'{path}.tmp', path)
+
+	# cache stays full precision
+	if low_memory:
+		df = compact(df)
+
 	return df
 
+# all year files in one pool (fork so workers don't rerun this script)
+years_basic0 = [2007, 2008, 2009, 2010]
+years_basic1 = [2011, 2012, 2013, 2014, 2015]
+years_goods = [2007, 2008, 2009, 2010, 2011, 2012, 2013, 2014, 2015]
+years_taxes0 = [2007, 2008, 2009]
+years_taxes1 = [2010, 2011, 2012, 2013, 2014, 2015]
+tasks = (
+	[(f'original/Basic_Information-{yr}.txt', cols_basic0) for yr in years_basic0] +
+	[(f'original/Basic_Information-{yr}.txt', cols_basic1) for yr in years_basic1] +
+	[(f'original/Goods_Service-{yr}.txt', cols_goods) for yr in years_goods] +
+	[(f'original/Taxation_Finance-{yr}.txt', cols_taxes0) for yr in years_taxes0] +
+	[(f'original/Taxation_Finance-{yr}.txt', cols_taxes1) for yr in years_taxes1]
+)
+tasks = [(fn, cols, args.low_memory) for fn, cols in tasks]
+
+print(f'loading {len(tasks)} year files')
+with get_context('fork').Pool(args.workers) as pool:
+	frames = pool.starmap(load_year, tasks)
+
+# hand over year frames in task order, dropping our reference so each is freed once concatenated
+take = lambda years: [frames.pop(0) for _ in years]
+report('loaded year files')
+
 # basic info
 print('loading basic info')
-basic0 = pd.concat([load_year(f'original/Basic_Information-{yr}.txt', cols_basic0) for yr in [2007, 2008, 2009, 2010]], sort=True)
-basic1 = pd.concat([load_year(f'original/Basic_Information-{yr}.txt', cols_basic1) for yr in [2011, 2012, 2013, 2014, 2015]], sort=True)
+basic0 = pd.concat(take(years_basic0), sort=True)
+basic1 = pd.concat(take(years_basic1), sort=True)
 basic = pd.concat([basic0, basic1], sort=True)
+del basic0, basic1
 
 # location fix
 basic['loccode'] = basic['loccode'].where(basic['year']>2011, basic['loccode'].replace(location))
 
 # industry fix
-ind0 = lambda s: s[1:] if type(s) is str else ''
-basic['industry_a'] = basic['industry_a'].apply(ind0).apply(sconv).astype('Int64')
-basic['industry_b'] = basic['industry_b'].apply(ind0).apply(sconv).astype('Int64')
 basic['industry'] = basic['industry_a'].fillna(basic['industry_b'].replace(industry))
 basic = basic.drop(['industry_a', 'industry_b'], axis=1)
 
 # goods info
 print('loading goods and services info')
-goods = pd.concat([load_year(f'original/Goods_Service-{yr}.txt', cols_goods) for yr in [2007, 2008, 2009, 2010, 2011, 2012, 2013, 2014, 2015]], sort=True)
+goods = pd.concat(take(years_goods), sort=True)
 goods = goods[goods['code']==0]
 
 # tax info
 print('loading tax and finance info')
-taxes0 = pd.concat([load_year(f'original/Taxation_Finance-{yr}.txt', cols_taxes0) for yr in [2007, 2008, 2009]], sort=True)
-taxes1 = pd.concat([load_year(f'original/Taxation_Finance-{yr}.txt', cols_taxes1) for yr in [2010, 2011, 2012, 2013, 2014, 2015]], sort=True)
+taxes0 = pd.concat(take(years_taxes0), sort=True)
+taxes1 = pd.concat(take(years_taxes1), sort=True)
 taxes = pd.concat([taxes0, taxes1], sort=True)
+del taxes0, taxes1
+del frames
 
 # employee fix
 taxes['employees'] = taxes['employees'].fillna(0.5*(taxes['employees_start']+taxes['employees_end']))
 taxes = taxes.drop(['employees_start', 'employees_end'], axis=1)
 
+# shared categorical ids so the merge aligns on codes
+if args.low_memory:
+	firmids = pd.concat([basic['firmid'], goods['firmid'], taxes['firmid']]).dropna().unique()
+	firm_dtype = pd.CategoricalDtype(firmids)
+	for df in [basic, goods, taxes]:
+		df['firmid'] = df['firmid'].astype(firm_dtype)
+	basic['regtype'] = basic['regtype'].astype('category')
+	del firmids
+
+report('loaded datasets')
+
 ##
 ## merge
 ##
@@ -131,6 +233,9 @@ print('merging datasets')
 index = ['firmid', 'year']
 conform = lambda df: df.dropna(subset=index).drop_duplicates(subset=index).set_index(index)
 firms = pd.concat([conform(df) for df in [basic, goods, taxes]], axis=1).reset_index()
+del basic, goods, taxes
+gc.collect()
+report('merged datasets')
 
 ##
 ## columns
@@ -146,19 +251,27 @@ firms['ind2'] = firms['industry'] // 100
 ## selections
 ##
 
+# comparisons with missing values fail
+ok = lambda mask: mask.fillna(False).astype(bool)
+
 # critical columns
-firms1 = firms.dropna(subset=['loccode', 'industry', 'ee', 'sales', 'sales_net', 'income_main'])
+keep = firms[['loccode', 'industry', 'ee', 'sales', 'sales_net', 'income_main']].notna().all(axis=1)
 
 # exclude finance
-firms1 = firms1[~((firms1['ind2']>=66)&(firms1['ind2']<=69))]
+keep &= ok(~((firms['ind2']>=66)&(firms['ind2']<=69)))
 
 # positive size
-firms1 = firms1[firms1['employees']>0]
+keep &= ok(firms['employees']>0)
 
 # sane values
-firms1 = firms1[(firms1['ind2']>0)&(firms1['ind2']<90)]
+keep &= ok((firms['ind2']>0)&(firms['ind2']<90))
 for col in ['ee', 'sales_net', 'income_main', 'cost_oper', 'asset_start', 'asset_end']:
-	firms1 = firms1[firms1[col]>=0]
+	keep &= ok(firms[col]>=0)
+
+# apply at once
+firms1 = firms[keep]
+del firms
+report('selected firms')
 
 ##
 ## save to disk
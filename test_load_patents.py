@@ -0,0 +1,45 @@
+import sqlite3
+import pytest
+import pandas as pd
+import pyarrow.dataset as ds
+from parse_patents import trans, patent_schema, patent_table
+from load_patents import load_patents
+
+# small parsed frame with both patent types
+def make_frame(n=20):
+    frame = pd.DataFrame({k: [f'{k}{i}' for i in range(n)] for k in trans})
+    frame['type'] = ['发明' if i % 2 == 0 else '实用新型' for i in range(n)]
+    frame['appdate'] = '2015.01.07'
+    frame['pubdate'] = '2016.02.03'
+    frame['pages'] = '3'
+    frame['appname'] = [f'公司{i};大学{i}' for i in range(n)]
+    return frame
+
+def type_counts(db):
+    with sqlite3.connect(db) as con:
+        return con.execute('select type, count(*) from patent group by type order by type').fetchall()
+
+def test_partitioned_matches_flat(tmp_path):
+    table = patent_table(make_frame(), patent_schema())
+
+    flat = str(tmp_path / 'patents.parquet')
+    ds.write_dataset(table, flat, format='parquet')
+    part = str(tmp_path / 'patents')
+    ds.write_dataset(table, part, format='parquet', partitioning=['type'], partitioning_flavor='hive')
+
+    load_patents([flat], str(tmp_path / 'flat.db'))
+    load_patents([part], str(tmp_path / 'part.db'), chunk=7)
+    assert type_counts(str(tmp_path / 'flat.db')) == [('发明', 10), ('实用新型', 10)]
+    assert type_counts(str(tmp_path / 'part.db')) == type_counts(str(tmp_path / 'flat.db'))
+
+def test_reload_needs_clobber(tmp_path):
+    path = str(tmp_path / 'patents.csv')
+    make_frame().to_csv(path, index=False)
+    db = str(tmp_path / 'patents.db')
+
+    assert load_patents([path], db) == 20
+    with pytest.raises(Exception):
+        load_patents([path], db)
+    assert load_patents([path], db, clobber=True) == 20
+    with sqlite3.connect(db) as con:
+        assert con.execute('select count(*) from patent').fetchone()[0] == 20
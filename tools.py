@@ -1,18 +1,52 @@
 # general tools
 
 import os
+import gzip
+import bz2
+import lzma
 import numpy as np
 import pandas as pd
+from queue import Queue
+from threading import Thread
 
-# just str and int for now
+# default patent store, written by load_patents.py and read by firm_merge.py
+patents_db = 'data/store/patents.db'
+
+# just str, int and float for now
 def astype(data, dtype):
     if dtype == 'str':
         return pd.Series(data, dtype='str')
     elif dtype == 'int':
         return pd.to_numeric(pd.Series(data), errors='coerce').astype('Int64')
+    elif dtype == 'float':
+        return pd.to_numeric(pd.Series(data), errors='coerce').astype('float64')
     else:
         raise Exception(f'Unsupported type: {dtype}')
 
+# fold full-width forms to ascii and drop whitespace
+def normalize_names(names):
+    return names.str.normalize('NFKC').str.replace(r'\s+', '', regex=True)
+
+# read csv or parquet table (file or partitioned directory), optionally only some columns
+def read_table(path, columns=None, **kwargs):
+    if path.endswith('.parquet') or os.path.isdir(path):
+        return pd.read_parquet(path, columns=columns)
+    else:
+        return pd.read_csv(path, usecols=columns, **kwargs)
+
+# stream chunks of csv or parquet table (hive partition columns restored as plain values)
+def read_chunks(path, chunk, columns=None, **kwargs):
+    if path.endswith('.parquet') or os.path.isdir(path):
+        import pyarrow.dataset as ds
+        partitioning = ds.HivePartitioning.discover(infer_dictionary=True)
+        data = ds.dataset(path, format='parquet', partitioning=partitioning)
+        for batch in data.to_batches(columns=columns, batch_size=chunk):
+            frame = batch.to_pandas()
+            cats = frame.select_dtypes('category').columns
+            yield frame.astype({c: object for c in cats})
+    else:
+        yield from pd.read_csv(path, usecols=columns, chunksize=chunk, **kwargs)
+
 # insert in chunks
 class ChunkWriter:
     def __init__(self, path, schema, chunk_size=1000, output=False):
@@ -55,7 +89,7 @@ class ChunkWriter:
             return
 
         if self.output:
-            print(f'Committing chunk {self.i} to {self.table} ({len(self.items)})')
+            print(f'Committing chunk {self.i} to {self.path} ({len(self.items)})')
 
         data = [x for x in zip(*self.items)]
         frame = pd.DataFrame({
@@ -68,3 +102,143 @@ class ChunkWriter:
     def delete(self):
         self.file.close()
         os.remove(self.path)
+
+# arrow types for schema
+arrow_types = {'str': 'string', 'int': 'int64', 'float': 'float64'}
+
+# compressed text openers by extension
+openers = {'.gz': gzip.open, '.bz2': bz2.open, '.xz': lzma.open}
+
+# insert in chunks into per-column buffers, writing on a background thread
+class ColumnWriter:
+    def __init__(self, path, schema, chunk_size=100_000, fmt=None, output=False, queue_size=4):
+        self.path = path
+        self.schema = schema
+        self.chunk_size = chunk_size
+        self.output = output
+        self.fmt = fmt if fmt is not None else ('parquet' if path.endswith('.parquet') else 'csv')
+        self.buffers = [[] for _ in schema]
+        self.size = 0
+        self.i = 0
+        self.j = 0
+        self.error = None
+        self.closed = False
+
+        # open output
+        if self.fmt == 'csv':
+            _, ext = os.path.splitext(path)
+            self.file = openers.get(ext, open)(path, 'wt')
+            header = ','.join(schema)
+            self.file.write(f'{header}\n')
+        elif self.fmt == 'parquet':
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            self.arrow_schema = pa.schema([(k, arrow_types[v]) for k, v in schema.items()])
+            self.file = pq.ParquetWriter(path, self.arrow_schema, compression='zstd')
+        else:
+            raise Exception(f'Unsupported format: {self.fmt}')
+
+        # bounded queue so producers only wait if the writer falls far behind
+        self.queue = Queue(maxsize=queue_size)
+        self.thread = Thread(target=self.worker, daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def insert(self, *args):
+        for buf, x in zip(self.buffers, args):
+            buf.append(x)
+        self.size += 1
+        if self.size >= self.chunk_size:
+            self.commit()
+            return True
+        else:
+            return False
+
+    def insertmany(self, args):
+        for buf, col in zip(self.buffers, zip(*args)):
+            buf.extend(col)
+        self.size += len(args)
+        if self.size >= self.chunk_size:
+            self.commit()
+            return True
+        else:
+            return False
+
+    # append a frame's schema columns straight onto the buffers
+    def insertframe(self, frame):
+        for buf, k in zip(self.buffers, self.schema):
+            buf.extend(frame[k].tolist())
+        self.size += len(frame)
+        if self.size >= self.chunk_size:
+            self.commit()
+            return True
+        else:
+            return False
+
+    # hand current buffers to writer thread
+    def commit(self):
+        self.check()
+        if self.size == 0:
+            return
+
+        self.i += 1
+        self.j += self.size
+
+        if self.output:
+            print(f'Committing chunk {self.i} to {self.path} ({self.size})')
+
+        self.queue.put(self.buffers)
+        self.buffers = [[] for _ in self.schema]
+        self.size = 0
+
+    # runs on writer thread
+    def worker(self):
+        while True:
+            buffers = self.queue.get()
+            if buffers is None:
+                break
+            if self.error is not None:
+                continue
+            try:
+                self.write(buffers)
+            except Exception as e:
+                self.error = e
+
+    def write(self, buffers):
+        frame = pd.DataFrame({
+            k: astype(d, v) for (k, v), d in zip(self.schema.items(), buffers)
+        })
+        if self.fmt == 'csv':
+            frame.to_csv(self.file, index=False, header=False)
+        else:
+            import pyarrow as pa
+            table = pa.Table.from_pandas(frame, schema=self.arrow_schema, preserve_index=False)
+            self.file.write_table(table)
+
+    # raise writer thread errors in producer
+    def check(self):
+        if self.error is not None:
+            raise self.error
+
+    # flush everything and close, always called on context exit
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            if self.error is None:
+                self.commit()
+        finally:
+            self.queue.put(None)
+            self.thread.join()
+            self.file.close()
+        self.check()
+
+    def delete(self):
+        self.close()
+        os.remove(self.path)
@@ -1,15 +1,26 @@
 import time
+import sqlite3
+import hashlib
 import torch
+import numpy as np
 import pandas as pd
 
-from transformers import AutoProcessor, SeamlessM4Tv2Model
-from ziggy.utils import batch_indices
-
 class SeamlessModel:
     def __init__(self, model='facebook/seamless-m4t-v2-large', device='cuda'):
+        from transformers import AutoProcessor, SeamlessM4Tv2Model
         self.processor = AutoProcessor.from_pretrained(model)
         self.model = SeamlessM4Tv2Model.from_pretrained(model).to(device)
 
+    # tokenized input lengths (as truncated for translate)
+    def lengths(self, texts, src_lang, max_length=64, chunk=100_000):
+        output = []
+        for i in range(0, len(texts), chunk):
+            text_inputs = self.processor(
+                text=texts[i:i+chunk], src_lang=src_lang, truncation=True, max_length=max_length
+            )
+            output += [len(ids) for ids in text_inputs['input_ids']]
+        return output
+
     def translate(self, texts, src_lang, tgt_lang, max_length=64):
         if type(texts) is str:
             texts = [texts]
@@ -35,32 +46,111 @@ class SeamlessModel:
         # return output texts
         return output_texts
 
+# persistent translations keyed by text hash and language pair
+class TranslationCache:
+    def __init__(self, path):
+        self.con = sqlite3.connect(path)
+        self.con.execute(
+            'create table if not exists translation (hash text, src_lang text, tgt_lang text, trans text, '
+            'primary key (hash, src_lang, tgt_lang))'
+        )
+
+    @staticmethod
+    def key(text):
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+    # cached translations of texts as dict
+    def get(self, texts, src_lang, tgt_lang, chunk=500):
+        keys = {self.key(t): t for t in texts}
+        hashes = list(keys)
+        output = {}
+        for i in range(0, len(hashes), chunk):
+            batch = hashes[i:i+chunk]
+            query = (
+                'select hash, trans from translation where src_lang = ? and tgt_lang = ? '
+                f'and hash in ({",".join("?"*len(batch))})'
+            )
+            for h, trans in self.con.execute(query, [src_lang, tgt_lang, *batch]):
+                output[keys[h]] = trans
+        return output
+
+    def put(self, pairs, src_lang, tgt_lang):
+        with self.con:
+            self.con.executemany(
+                'insert or replace into translation values (?, ?, ?, ?)',
+                [(self.key(t), src_lang, tgt_lang, trans) for t, trans in pairs]
+            )
+
+    def close(self):
+        self.con.close()
+
+# translate distinct uncached texts in length-sorted batches, returned in input order
+def translate_texts(
+    texts, model, src_lang='cmn', tgt_lang='eng', cache=None,
+    batch_size=64, max_tokens=None
+):
+    # distinct non-empty texts not already cached
+    unique = list(dict.fromkeys(t for t in texts if type(t) is str and len(t) > 0))
+    done = cache.get(unique, src_lang, tgt_lang) if cache is not None else {}
+    todo = [t for t in unique if t not in done]
+    print(f'{len(texts)} texts, {len(unique)} distinct, {len(done)} cached, {len(todo)} to translate')
+
+    # longest first so batches pad little and memory problems show up early
+    if hasattr(model, 'lengths'):
+        lengths = np.asarray(model.lengths(todo, src_lang=src_lang), dtype=np.int64)
+    else:
+        lengths = np.array([len(t) for t in todo], dtype=np.int64)
+    order = np.argsort(-lengths, kind='stable')
+
+    # batches of at most batch_size texts (and max_tokens padded tokens)
+    i1 = 0
+    while i1 < len(todo):
+        size = batch_size
+        if max_tokens is not None:
+            size = max(1, min(batch_size, max_tokens // max(1, lengths[order[i1]])))
+        i2 = min(i1 + size, len(todo))
+        print(f'{i1} → {i2}')
+
+        # translate and remember
+        batch = [todo[j] for j in order[i1:i2]]
+        trans = model.translate(batch, src_lang=src_lang, tgt_lang=tgt_lang)
+        if cache is not None:
+            cache.put(zip(batch, trans), src_lang, tgt_lang)
+        done.update(zip(batch, trans))
+        i1 = i2
+
+    return [done.get(t) for t in texts]
+
 def translate_patents(
     path_pats='data/tables/patents.csv', path_tran='data/tables/translate.csv',
-    batch_size=64, max_rows=None
+    path_cache='data/tables/translate_cache.db', # None to disable
+    batch_size=64, max_tokens=None, max_rows=None,
+    src_lang='cmn', tgt_lang='eng', model=None
 ):
     # load patent metadata
     print('Loading patent metadata')
     pats = pd.read_csv(path_pats, usecols=['patnum', 'title'], nrows=max_rows)
 
     # load seamless model
-    print('Loading seamless model')
-    torch.set_float32_matmul_precision('high')
-    model = SeamlessModel()
+    if model is None:
+        print('Loading seamless model')
+        torch.set_float32_matmul_precision('high')
+        model = SeamlessModel()
 
-    # set up output list
-    output = []
+    # open translation cache
+    cache = TranslationCache(path_cache) if path_cache is not None else None
     time0 = time.time()
 
-    # translate titles and abstracts
+    # translate titles
     print('Translating titles')
-    for i1, i2 in batch_indices(len(pats), batch_size):
-        print(f'{i1} → {i2}')
-
-        # translate titles
-        titles = pats['title'].iloc[i1:i2].tolist()
-        trans = model.translate(titles, src_lang='cmn', tgt_lang='eng')
-        output += trans
+    try:
+        output = translate_texts(
+            pats['title'].tolist(), model, src_lang=src_lang, tgt_lang=tgt_lang,
+            cache=cache, batch_size=batch_size, max_tokens=max_tokens
+        )
+    finally:
+        if cache is not None:
+            cache.close()
 
     # print time taken
     time1 = time.time()